@@ -0,0 +1,253 @@
+# Загрузка счётчиков сообщений из экспорта истории группы (Telegram Desktop, JSON).
+#
+# Экспорт читается потоково (ijson), поэтому расход памяти не зависит от размера
+# файла. Учитываются те же сообщения, что и в count_messages: сервисные записи,
+# команды, пересланные сообщения и записи не от пользователей пропускаются.
+# Счётчики копятся пакетами по --batch-size сообщений; каждый пакет записывается
+# одной транзакцией (executemany) вместе со сводками активности и номером последнего
+# обработанного сообщения в bot_state. Прерванную загрузку достаточно запустить
+# снова — она продолжится с места остановки, а повторный запуск не удвоит счётчики.
+#
+#   python backfill.py result.json --before-id 123456 --dry-run
+#   python backfill.py result.json --before-date 2024-05-01T00:00:00+03:00
+#
+# --before-id / --before-date — первое сообщение, которое бот уже посчитал сам;
+# всё, что новее, в загрузку не попадает. Запускать лучше при остановленном боте:
+# таблицы лидеров и кэш рангов перечитываются из базы только при старте.
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+# Действие сервисной записи экспорта -> поле сервисного сообщения Bot API
+EXPORT_SERVICE_ACTIONS = {
+    "invite_members": "new_chat_members",
+    "join_group_by_link": "new_chat_members",
+    "join_group_by_request": "new_chat_members",
+    "remove_members": "left_chat_member",
+    "pin_message": "pinned_message",
+}
+# У супергрупп и каналов Bot API добавляет к id из экспорта префикс -100
+SUPERGROUP_EXPORT_TYPES = frozenset(("private_supergroup", "public_supergroup", "private_channel", "public_channel"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Backfill message counts from a Telegram Desktop JSON export.")
+    parser.add_argument("export", help="path to result.json exported by Telegram Desktop")
+    cutoff = parser.add_mutually_exclusive_group(required=True)
+    cutoff.add_argument("--before-id", type=int, help="first message id already counted by the bot")
+    cutoff.add_argument("--before-date", help="ISO date/time the bot started counting (UTC unless an offset is given)")
+    parser.add_argument("--chat-id", type=int, help="chat id as the bot sees it (default: derived from the export)")
+    parser.add_argument("--batch-size", type=int, default=100000, help="messages per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="parse and report without writing to the database")
+    return parser.parse_args()
+
+
+def export_chat_id(ijson, path):
+    # Поля type и id идут в экспорте перед списком сообщений, поэтому файл не дочитывается
+    header = {}
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix in ("type", "id"):
+                header[prefix] = value
+            elif prefix == "messages":
+                break
+    if "id" not in header:
+        raise ValueError("export has no chat id, pass --chat-id")
+    if header.get("type") in SUPERGROUP_EXPORT_TYPES:
+        return int(f"-100{header['id']}")
+    return -int(header["id"])
+
+
+def parse_cutoff_date(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def message_timestamp(message):
+    # date_unixtime есть только в экспортах новых версий Telegram Desktop; в старых
+    # только date — местное время компьютера, на котором делался экспорт
+    if "date_unixtime" in message:
+        return int(message["date_unixtime"])
+    if "date" in message:
+        return int(datetime.fromisoformat(message["date"]).timestamp())
+    return None
+
+
+def read_checkpoint(main, key):
+    # Пробный прогон не открывает базу на запись и не применяет миграции
+    if not os.path.exists(main.DB_PATH):
+        return 0
+    conn = sqlite3.connect(f"file:{main.DB_PATH}?mode=ro", uri=True)
+    try:
+        row = conn.execute(main.SELECT_STATE_SQL, (key,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None  # база ещё не создана ботом
+    finally:
+        conn.close()
+    return int(row[0]) if row else 0
+
+
+def exclusion_reason(message, bot_user_id):
+    # Причина, по которой count_messages не посчитал бы это сообщение, или None
+    if message.get("type") != "message":
+        return "service:" + EXPORT_SERVICE_ACTIONS.get(message.get("action"), "other")
+    from_id = message.get("from_id") or ""
+    if not from_id.startswith("user"):
+        return "not_a_user"  # от имени канала или анонимного администратора (sender_chat в Bot API)
+    if from_id == bot_user_id:
+        return "bot"
+    if "forwarded_from" in message:
+        return "forward"
+    entities = message.get("text_entities") or []
+    # text_entities покрывают весь текст по порядку, так что первая — это смещение 0
+    if entities and entities[0].get("type") == "bot_command":
+        return "command"
+    return None
+
+
+class Batch:
+    def __init__(self, chat_id, main):
+        self.chat_id = chat_id
+        self.main = main
+        self.messages = 0
+        self.counts = {}  # user_id -> [сообщений, имя]
+        self.hourly = Counter()  # (час, user_id) -> сообщений
+        self.last_id = None
+
+    def add(self, user_id, name, timestamp):
+        entry = self.counts.get(user_id)
+        if entry:
+            entry[0] += 1
+            entry[1] = name
+        else:
+            self.counts[user_id] = [1, name]
+        self.hourly[(self.main.activity_hour(timestamp), user_id)] += 1
+        self.messages += 1
+
+    def activity_rows(self):
+        # Интервалы старше срока хранения всё равно удалил бы ActivityCompactor
+        current_hour = self.main.activity_hour(time.time())
+        first_hour = current_hour - self.main.ACTIVITY_HOURLY_RETENTION_DAYS * 24
+        first_day = current_hour // 24 - self.main.ACTIVITY_DAILY_RETENTION_DAYS
+        daily = Counter()
+        hourly_rows = []
+        for (hour, user_id), count in self.hourly.items():
+            if hour >= first_hour:
+                hourly_rows.append((self.chat_id, hour, user_id, count))
+            if hour // 24 >= first_day:
+                daily[(hour // 24, user_id)] += count
+        daily_rows = [(self.chat_id, day, user_id, count) for (day, user_id), count in daily.items()]
+        return {"activity_hourly": hourly_rows, "activity_daily": daily_rows}
+
+    def rows(self):
+        return [(self.chat_id, user_id, name, count) for user_id, (count, name) in self.counts.items()]
+
+
+async def run(args):
+    import ijson
+    import main
+
+    chat_id = args.chat_id if args.chat_id is not None else export_chat_id(ijson, args.export)
+    if not main.settings.is_discussion_group(chat_id):
+        main.logger.warning("Chat %s is not a configured discussion group; its counts will not be shown by the bot.", chat_id)
+    token = os.getenv("BOT_TOKEN")
+    bot_user_id = f"user{token.split(':', 1)[0]}" if token else None
+    cutoff_date = parse_cutoff_date(args.before_date) if args.before_date else None
+    state_key = f"backfill:{chat_id}"
+
+    if args.dry_run:
+        checkpoint = read_checkpoint(main, state_key)
+    else:
+        await main.db.open()
+        checkpoint = int(await main.db.get_state(state_key) or 0)
+    if checkpoint:
+        main.logger.info("Resuming backfill of chat %s after message %s.", chat_id, checkpoint)
+
+    excluded = Counter()
+    totals = Counter()
+    names = {}
+    scanned = resumed = batches = 0
+    reached_cutoff = False
+    batch = Batch(chat_id, main)
+    started = time.perf_counter()
+
+    async def commit(batch):
+        if batch.last_id is None:
+            return
+        if not args.dry_run:
+            await main.db.add_backfill_counts(batch.rows(), batch.activity_rows(), {state_key: str(batch.last_id)})
+            main.logger.info("Committed backfill batch up to message %s (%s messages).", batch.last_id, batch.messages)
+
+    with open(args.export, "rb") as f:
+        for message in ijson.items(f, "messages.item"):
+            message_id = int(message.get("id", 0))
+            if message_id <= checkpoint:
+                resumed += 1
+                continue
+            timestamp = message_timestamp(message)
+            # Сообщения в экспорте упорядочены, поэтому после границы читать дальше не нужно
+            if (args.before_id is not None and message_id >= args.before_id) or (
+                cutoff_date is not None and timestamp is not None and timestamp >= cutoff_date
+            ):
+                reached_cutoff = True
+                break
+            scanned += 1
+            batch.last_id = message_id
+            reason = exclusion_reason(message, bot_user_id) or (None if timestamp is not None else "no_date")
+            if reason:
+                excluded[reason] += 1
+                continue
+
+            user_id = int(message["from_id"][4:])
+            name = message.get("from") or None
+            batch.add(user_id, name, timestamp)
+            totals[user_id] += 1
+            names[user_id] = name
+            if batch.messages >= args.batch_size:
+                await commit(batch)
+                batches += 1
+                batch = Batch(chat_id, main)
+
+    await commit(batch)
+    if batch.last_id is not None:
+        batches += 1
+    if not args.dry_run:
+        await main.db.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "chat_id": chat_id,
+        "dry_run": args.dry_run,
+        "resumed_after_message": checkpoint or None,
+        "skipped_before_checkpoint": resumed,
+        "scanned": scanned,
+        "counted": sum(totals.values()),
+        "excluded": dict(excluded),
+        "reached_cutoff": reached_cutoff,
+        "users": len(totals),
+        "batches": batches,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round((scanned + resumed) / elapsed, 1) if elapsed else None,
+        "top_users": [[user_id, names[user_id], count] for user_id, count in totals.most_common(10)],
+    }
+
+
+def main_cli():
+    args = parse_args()
+    if args.batch_size < 1:
+        print("--batch-size must be positive", file=sys.stderr)
+        sys.exit(2)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
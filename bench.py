@@ -0,0 +1,284 @@
+# Нагрузочный бенчмарк конвейера вебхука без сети.
+#
+# Генерирует поток синтетических обновлений Telegram (текст и стикеры в группе,
+# пересланные посты канала, команды, /random в личке, сообщения из чужих чатов),
+# прогоняет их через FastAPI-приложение из main.py по ASGI-транспорту, а Bot API
+# подменяет локальной заглушкой. Выводит пропускную способность, p50/p95/p99
+# задержки /webhook и число записей в SQLite.
+#
+#   python bench.py --updates 5000 --concurrency 32
+#   python bench.py --fast-ack --max-p99-ms 50 --json bench_output.txt
+#
+# С --max-p99-ms или --min-throughput скрипт завершается с кодом 1, если результат
+# хуже порога, поэтому его можно использовать как проверку на регрессии. Прогон идёт
+# с настройками main.py по умолчанию: обновления, на которые вебхук ответил не 200,
+# не входят в пропускную способность, а при --max-p99-ms считаются провалом.
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+GROUP_ID = -1001000000001
+CHANNEL_ID = -1001000000002
+FOREIGN_GROUP_ID = -1001000000003
+BOT_TOKEN = "123456:BENCHMARK"
+BOT_USERNAME = "uberbot_bench"
+
+# Доля каждого вида обновлений в потоке
+UPDATE_MIX = (
+    ("group_text", 50),
+    ("group_sticker", 10),
+    ("channel_forward", 3),
+    ("group_command", 10),
+    ("private_random", 5),
+    ("private_text", 2),
+    ("foreign_chat", 15),
+    ("edited_message", 5),
+)
+GROUP_COMMANDS = ("/rank", "/top", "/top 20", "/stats", "/stats week", "/flood", "/site", "/servers", "/partners", "/ping", "/help")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the /webhook pipeline.")
+    parser.add_argument("--updates", type=int, default=5000, help="number of updates to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="webhook requests in flight")
+    parser.add_argument("--users", type=int, default=2000, help="size of the simulated member pool")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the update stream")
+    parser.add_argument("--fast-ack", action="store_true", help="benchmark WEBHOOK_FAST_ACK mode")
+    parser.add_argument("--inline-replies", action="store_true", help="benchmark INLINE_REPLIES mode")
+    parser.add_argument("--max-p99-ms", type=float, help="fail if webhook p99 latency is above this")
+    parser.add_argument("--min-throughput", type=float, help="fail if throughput (updates/s) is below this")
+    parser.add_argument("--json", dest="json_path", help="also write the report as JSON to this file")
+    return parser.parse_args()
+
+
+class UpdateStream:
+    def __init__(self, seed, users):
+        self.random = random.Random(seed)
+        self.users = users
+        self.update_id = 100000
+        self.message_id = 0
+        self.kinds = [kind for kind, _ in UPDATE_MIX]
+        self.weights = [weight for _, weight in UPDATE_MIX]
+
+    def _user(self):
+        # Активность участников сильно неравномерна: небольшая часть пишет большую часть сообщений
+        user_id = int(self.random.paretovariate(1.2)) % self.users + 1
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, chat, user, **fields):
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": chat, "from": user}
+        message.update(fields)
+        return message
+
+    @staticmethod
+    def _command(text):
+        return {"text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+
+    def _wrap(self, key, message):
+        self.update_id += 1
+        return {"update_id": self.update_id, key: message}
+
+    def generate(self, count):
+        group = {"id": GROUP_ID, "type": "supergroup", "title": "Bench group"}
+        for kind in self.random.choices(self.kinds, self.weights, k=count):
+            user = self._user()
+            private = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+            if kind == "group_text":
+                yield self._wrap("message", self._message(group, user, text="сообщение " * self.random.randint(1, 12)))
+            elif kind == "group_sticker":
+                sticker = {"file_id": "sticker", "file_unique_id": "sticker", "width": 512, "height": 512,
+                           "is_animated": False, "is_video": False, "type": "regular"}
+                yield self._wrap("message", self._message(group, user, sticker=sticker))
+            elif kind == "channel_forward":
+                channel = {"id": CHANNEL_ID, "type": "channel", "title": "Bench channel"}
+                yield self._wrap("message", self._message(group, user, text="Новый пост", forward_from_chat=channel,
+                                                          forward_date=int(time.time())))
+            elif kind == "group_command":
+                yield self._wrap("message", self._message(group, user, **self._command(self.random.choice(GROUP_COMMANDS))))
+            elif kind == "private_random":
+                yield self._wrap("message", self._message(private, user, **self._command("/random")))
+                start = self.random.randint(1, 50)
+                yield self._wrap("message", self._message(private, user, text=f"{start}-{start + self.random.randint(0, 100)}"))
+            elif kind == "private_text":
+                yield self._wrap("message", self._message(private, user, text="привет"))
+            elif kind == "foreign_chat":
+                foreign = {"id": FOREIGN_GROUP_ID, "type": "supergroup", "title": "Other group"}
+                yield self._wrap("message", self._message(foreign, user, text="чужой чат"))
+            elif kind == "edited_message":
+                yield self._wrap("edited_message", self._message(group, user, text="исправлено", edit_date=int(time.time())))
+
+
+class TelegramStub:
+    # Минимальная ASGI-заглушка Bot API: отвечает ok на любой метод и считает вызовы
+    def __init__(self):
+        self.calls = Counter()
+        self.message_id = 0
+        self.webhook_url = ""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            event = await receive()
+            body += event.get("body", b"")
+            if not event.get("more_body"):
+                break
+        method = scope["path"].rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        params = dict(parse_qsl(body.decode())) if body else {}
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        elif method in ("sendMessage", "sendSticker"):
+            self.message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            result = {"message_id": self.message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                      "text": params.get("text", "")}
+        elif method == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            result = True
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]})
+        await send({"type": "http.response.body", "body": payload})
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run(args):
+    import httpx
+    import uvicorn
+    import main
+
+    stub = TelegramStub()
+    stub_server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=0, log_config=None, lifespan="off"))
+    stub_task = asyncio.create_task(stub_server.serve())
+    while not stub_server.started:
+        await asyncio.sleep(0.01)
+    stub_port = stub_server.servers[0].sockets[0].getsockname()[1]
+
+    main.application = main.build_application(BOT_TOKEN, f"http://127.0.0.1:{stub_port}/bot")
+    await main.application.initialize()
+    await main.start_services()
+
+    updates = list(UpdateStream(args.seed, args.users).generate(args.updates))
+    latencies = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send_update(update):
+            body = json.dumps(update).encode()
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/webhook", content=body, headers={"content-type": "application/json"})
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send_update(update) for update in updates))
+        # В режиме быстрого ответа обработка продолжается после ответа вебхука
+        await main.update_queue.drain(main.UPDATE_DRAIN_TIMEOUT)
+        elapsed = time.perf_counter() - started
+
+    await main.conversation_store.stop()
+    await main.message_counter.stop()
+    total_changes = await main.db.total_changes()
+    await main.db.close()
+    await main.application.shutdown()
+    stub_server.should_exit = True
+    await stub_task
+
+    report = {
+        "updates": len(updates),
+        "concurrency": args.concurrency,
+        "mode": "fast-ack" if args.fast_ack else "sync",
+        "inline_replies": args.inline_replies,
+        "elapsed_s": round(elapsed, 3),
+        # Отклонённое обновление Telegram доставит повторно позже, поэтому в
+        # пропускную способность идут только принятые
+        "throughput_per_s": round(statuses[200] / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "mean": round(statistics.fmean(latencies) * 1000, 3),
+        },
+        "http_statuses": dict(statuses),
+        "rejected": len(updates) - statuses[200],
+        "sqlite": {
+            "flush_transactions": main.metrics.histogram_count("db_seconds", (("op", "add_message_counts"),)),
+            "rows_changed": total_changes,
+        },
+        "flood_dropped_messages": main.flood_detector.dropped,
+        "bot_api_calls": dict(stub.calls),
+    }
+    return report
+
+
+def main_cli():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="uberbot-bench-")
+    # Настройки main.py читаются при импорте, поэтому окружение задаётся до него
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "BOT_TOKEN": BOT_TOKEN,
+        "DISCUSSION_GROUP_ID": str(GROUP_ID),
+        "CHANNEL_ID": str(CHANNEL_ID),
+        "WEBHOOK_FAST_ACK": "1" if args.fast_ack else "0",
+        "INLINE_REPLIES": "1" if args.inline_replies else "0",
+        "TELEGRAM_HTTP_VERSION": "1.1",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        # Весь прогон укладывается в секунды, и самые активные участники из UpdateStream
+        # попали бы под защиту от флуда; по умолчанию она выключена, чтобы замеры
+        # оставались сравнимы с прежними
+        "FLOOD_MAX_MESSAGES": os.getenv("FLOOD_MAX_MESSAGES", "0"),
+        # Лимиты Telegram к заглушке не относятся
+        "SEND_GLOBAL_RATE": "1000000",
+        "SEND_PRIVATE_RATE": "1000000",
+        "SEND_GROUP_RATE_PER_MINUTE": "60000000",
+        "SEND_GROUP_BURST": "1000000",
+    })
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    failed = False
+    if args.max_p99_ms is not None and report["latency_ms"]["p99"] > args.max_p99_ms:
+        print(f"FAIL: p99 {report['latency_ms']['p99']} ms > {args.max_p99_ms} ms", file=sys.stderr)
+        failed = True
+    # Задержка отклонённого обновления — это задержка повторной доставки, а не быстрый 503
+    if args.max_p99_ms is not None and report["rejected"]:
+        print(f"FAIL: {report['rejected']} webhooks were not accepted", file=sys.stderr)
+        failed = True
+    if args.min_throughput is not None and report["throughput_per_s"] < args.min_throughput:
+        print(f"FAIL: throughput {report['throughput_per_s']}/s < {args.min_throughput}/s", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
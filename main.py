@@ -1,121 +1,1204 @@
 import asyncio
+import atexit
+import contextlib
+import heapq
+import importlib.util
+import json
 import os
 import logging
+import multiprocessing
 import sqlite3
 import random
-import uvicorn
+import signal
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 from telegram import Update
 from telegram.ext import (
     Application,
-    MessageHandler,
-    filters,
-    CommandHandler,
+    BaseRateLimiter,
+    CallbackContext,
+    TypeHandler,
     ContextTypes
 )
-from telegram.error import TelegramError
+from telegram.error import RetryAfter, TelegramError
 from fastapi import FastAPI, Request, Response
 
+try:
+    # orjson заметно быстрее разбирает тело вебхука; без него используем стандартный json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # --- Настройка логирования ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Обработчики только кладут записи в очередь; форматирование и запись в stderr
+# выполняет фоновый поток QueueListener, а не цикл событий. Частые INFO-сообщения
+# одного шаблона ограничиваются по количеству в секунду, WARNING и выше
+# пропускаются всегда. LOG_FORMAT=json включает структурированный вывод.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))  # записей одного шаблона в секунду, 0 — без ограничения
+
+class LogRateLimitFilter(logging.Filter):
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self.suppressed = 0
+        self._window = 0
+        self._counts = {}  # шаблон сообщения -> записей в текущей секунде
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.per_second:
+            return True
+        window = int(record.created)
+        if window != self._window:
+            self._window = window
+            self._counts.clear()
+        # Ключ — шаблон до подстановки аргументов, поэтому сообщения о разных
+        # пользователях одного типа ограничиваются вместе
+        count = self._counts.get(record.msg, 0) + 1
+        self._counts[record.msg] = count
+        if count > self.per_second:
+            self.suppressed += 1
+            return False
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Стандартный QueueHandler форматирует запись в вызывающем потоке;
+        # здесь это откладывается до фонового потока
+        return record
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    rate_limit_filter = LogRateLimitFilter(LOG_RATE_LIMIT)
+    queue_handler.addFilter(rate_limit_filter)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener, rate_limit_filter
+
+log_listener, log_rate_limit_filter = setup_logging()
 logger = logging.getLogger(__name__)
 
+# --- Метрики в формате Prometheus ---
+# Счётчики и гистограммы — обычные словари, которые меняются только из потока
+# цикла событий, поэтому не требуют блокировок и дёшевы для постоянного включения.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # Метки, которые добавляются ко всем сериям процесса (в режиме нескольких процессов —
+        # process="writer" или process="worker<N>")
+        self.process_labels = ()
+        self.writer_only = set()   # серии объектов, которые в режиме нескольких процессов живут в писателе
+        self.is_worker = False     # рабочий процесс не выводит серии из writer_only
+        self._help = {}        # имя -> (тип, описание)
+        self._counters = {}    # (имя, метки) -> значение
+        self._gauges = {}      # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счётчики по корзинам..., +Inf, сумма]
+        self._callbacks = {}   # имя -> функция, возвращающая текущее значение
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge_add(self, name, value, labels=()):
+        key = (name, labels)
+        self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def collect(self, name, kind, help_text, callback, writer_only=False):
+        # Значение берётся из callback в момент выдачи метрик
+        self.describe(name, kind, help_text)
+        self._callbacks[name] = callback
+        if writer_only:
+            self.writer_only.add(name)
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def histogram_count(self, name, labels=()):
+        histogram = self._histograms.get((name, labels))
+        return sum(histogram[:-1]) if histogram else 0
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    @staticmethod
+    def _escape(value):
+        # Экранирование значений меток по формату Prometheus
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _series(self, name, labels, extra=()):
+        pairs = labels + extra
+        label_text = ",".join(f'{key}="{self._escape(value)}"' for key, value in pairs)
+        return f"{self.prefix}_{name}{{{label_text}}}" if label_text else f"{self.prefix}_{name}"
+
+    def snapshot(self):
+        # Значения всех серий с метками процесса; сериализуется в JSON для писателя
+        extra = self.process_labels
+        return {
+            "help": self._help,
+            "counters": [[name, labels + extra, value] for (name, labels), value in self._counters.items()],
+            "gauges": [[name, labels + extra, value] for (name, labels), value in self._gauges.items()],
+            "callbacks": [
+                [name, extra, callback()] for name, callback in self._callbacks.items()
+                if not (self.is_worker and name in self.writer_only)
+            ],
+            "histograms": [[name, labels + extra, histogram] for (name, labels), histogram in self._histograms.items()],
+        }
+
+    def render(self, snapshots=()):
+        # snapshots — снимки других процессов; серии одной метрики выводятся вместе под одним заголовком
+        help_texts = {}
+        families = {}  # имя -> строки серий
+        for snapshot in (self.snapshot(),) + tuple(snapshots):
+            for name, (kind, help_text) in snapshot["help"].items():
+                help_texts.setdefault(name, (kind, help_text))
+            samples = sorted(snapshot["counters"]) + sorted(snapshot["gauges"]) + sorted(snapshot["callbacks"])
+            for name, labels, value in samples:
+                labels = tuple(tuple(pair) for pair in labels)
+                families.setdefault(name, []).append(f"{self._series(name, labels)} {value}")
+            for name, labels, histogram in sorted(snapshot["histograms"]):
+                labels = tuple(tuple(pair) for pair in labels)
+                lines = families.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f"{self._series(name + '_bucket', labels, (('le', bound),))} {cumulative}")
+                cumulative += histogram[-2]
+                lines.append(f"{self._series(name + '_bucket', labels, (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{self._series(name + '_sum', labels)} {histogram[-1]:.6f}")
+                lines.append(f"{self._series(name + '_count', labels)} {cumulative}")
+
+        lines = []
+        for name in sorted(families):
+            if name in help_texts:
+                kind, help_text = help_texts[name]
+                lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+            lines.extend(families[name])
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics("uberbot")
+metrics.describe("updates_total", "counter", "Webhook updates by update type and outcome.")
+metrics.describe("errors_total", "counter", "Errors by place where they happened.")
+metrics.describe("webhooks_in_flight", "gauge", "Webhook requests currently being handled.")
+metrics.describe("process_update_seconds", "histogram", "Time spent in Application.process_update.")
+metrics.describe("handler_seconds", "histogram", "Time spent in each update handler.")
+metrics.describe("db_seconds", "histogram", "Time of database operations including the wait for the DB thread.")
+metrics.describe("api_seconds", "histogram", "Time of outbound Bot API calls by method.")
+metrics.collect("log_records_suppressed", "counter", "Log records dropped by the rate limit filter.", lambda: log_rate_limit_filter.suppressed)
+
 # --- Инициализация FastAPI ---
 app = FastAPI()
 application = None # Инициализируем как None, будет установлено в main()
 
-# --- Инициализация базы данных SQLite ---
-def init_db():
-    conn = None
-    try:
-        # Убедитесь, что путь '/app/bot.db' доступен для записи в контейнере Render
-        conn = sqlite3.connect('/app/bot.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                message_count INTEGER DEFAULT 0,
-                rank TEXT DEFAULT 'Странник Эфира'
-            )
-        ''')
-        conn.commit()
-        logger.info("Database initialized successfully.")
-    except Exception as e:
-        logger.error(f"Failed to initialize database: {e}")
-    finally:
-        if conn:
-            conn.close()
+# --- Настройки, загружаемые один раз при старте ---
+# Бот может обслуживать несколько дискуссионных групп. Каждой группе можно
+# сопоставить канал, посты которого пересылаются в неё:
+#   DISCUSSION_GROUP_IDS="-1001,-1002"
+#   GROUP_CHANNELS="-1001:-1009,-1002:-1008"   (группа:канал)
+# Старые переменные DISCUSSION_GROUP_ID и CHANNEL_ID по-прежнему поддерживаются.
+@dataclass(frozen=True)
+class Settings:
+    discussion_groups: frozenset
+    group_channels: dict  # group_id -> channel_id
+    legacy_group_id: Optional[int] = None
+
+    @classmethod
+    def from_env(cls):
+        def parse_ids(value):
+            return [int(item) for item in value.split(",") if item.strip()]
+
+        legacy_group = os.getenv("DISCUSSION_GROUP_ID", "").strip()
+        legacy_group_id = int(legacy_group) if legacy_group else None
+        groups = set(parse_ids(os.getenv("DISCUSSION_GROUP_IDS", "")))
+        channels = {}
+        for pair in os.getenv("GROUP_CHANNELS", "").split(","):
+            if not pair.strip():
+                continue
+            group_id, channel_id = pair.split(":", 1)
+            channels[int(group_id)] = int(channel_id)
+
+        if legacy_group_id is not None:
+            groups.add(legacy_group_id)
+            legacy_channel = os.getenv("CHANNEL_ID", "").strip()
+            if legacy_channel:
+                channels.setdefault(legacy_group_id, int(legacy_channel))
+        groups.update(channels)
+        return cls(frozenset(groups), channels, legacy_group_id)
+
+    def is_discussion_group(self, chat_id):
+        return chat_id in self.discussion_groups
+
+settings = Settings.from_env()
+
+# --- Слой доступа к базе данных SQLite ---
+# Одно долгоживущее соединение в режиме WAL. Все запросы выполняются в отдельном
+# потоке, чтобы обращения к диску не блокировали цикл событий.
+DB_PATH = os.getenv("DB_PATH", "/app/bot.db")  # Путь должен быть доступен для записи в контейнере Render
+
+def migrate_per_chat_counters(conn):
+    # Счётчики старой таблицы users относятся к группе из DISCUSSION_GROUP_ID или, если
+    # она не задана, к единственной настроенной группе. Если группу определить нельзя,
+    # миграция не применяется (версия схемы не повышается), и бот не запускается
+    conn.execute("""
+        CREATE TABLE chat_users (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_chat_users_message_count ON chat_users (chat_id, message_count DESC)")
+    group_id = settings.legacy_group_id
+    if group_id is None and len(settings.discussion_groups) == 1:
+        group_id = next(iter(settings.discussion_groups))
+    if group_id is not None:
+        conn.execute(
+            "INSERT INTO chat_users (chat_id, user_id, username, message_count) SELECT ?, user_id, username, message_count FROM users",
+            (group_id,)
+        )
+    elif conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        logger.critical("Cannot tell which discussion group the existing message counts belong to.")
+        raise ValueError("Set DISCUSSION_GROUP_ID to the group of the existing counters to migrate them")
+    conn.execute("DROP TABLE users")
+
+# Версионные миграции схемы: номер версии хранится в PRAGMA user_version.
+# Каждая миграция (SQL-скрипт или функция) выполняется в одной транзакции
+# вместе с повышением версии.
+MIGRATIONS = [
+    # 1: исходная схема (в уже развёрнутых базах таблицы существуют)
+    (1, """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            message_count INTEGER DEFAULT 0,
+            rank TEXT DEFAULT 'Странник Эфира'
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_message_count ON users (message_count DESC);
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """),
+    # 2: ранг больше не хранится текстом в каждой строке, а вычисляется при чтении
+    (2, """
+        CREATE TABLE users_v2 (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO users_v2 (user_id, username, message_count)
+            SELECT user_id, username, COALESCE(message_count, 0) FROM users;
+        DROP TABLE users;
+        ALTER TABLE users_v2 RENAME TO users;
+        CREATE INDEX IF NOT EXISTS idx_users_message_count ON users (message_count DESC);
+    """),
+    # 3: счётчики ведутся отдельно для каждой группы
+    (3, migrate_per_chat_counters),
+    # 4: сводки активности по часам и суткам для /stats; bucket — номер часа или суток
+    # с начала эпохи по времени ACTIVITY_UTC_OFFSET
+    (4, """
+        CREATE TABLE activity_hourly (
+            chat_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, bucket, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE activity_daily (
+            chat_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, bucket, user_id)
+        ) WITHOUT ROWID;
+    """),
+    # 5: user_data и chat_data переживают перезапуск; kind — 'user' или 'chat', data — JSON
+    (5, """
+        CREATE TABLE conversation_state (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_conversation_state_updated_at ON conversation_state (updated_at);
+    """),
+]
+SELECT_MESSAGE_COUNT_SQL = "SELECT message_count FROM chat_users WHERE chat_id = ? AND user_id = ?"
+UPSERT_COUNTS_SQL = """
+    INSERT INTO chat_users (chat_id, user_id, username, message_count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        username = excluded.username,
+        message_count = message_count + excluded.message_count
+"""
+# Загрузка истории (backfill.py): имя из экспорта не заменяет уже известный username
+UPSERT_BACKFILL_COUNTS_SQL = """
+    INSERT INTO chat_users (chat_id, user_id, username, message_count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        username = COALESCE(chat_users.username, excluded.username),
+        message_count = message_count + excluded.message_count
+"""
+SELECT_TOP_USERS_SQL = "SELECT user_id, username, message_count FROM chat_users WHERE chat_id = ? ORDER BY message_count DESC LIMIT ?"
+# Запросы к сводкам одинаковы для обеих таблиц; первичный ключ (chat_id, bucket, user_id)
+# позволяет читать и удалять только нужный диапазон интервалов одной группы
+ACTIVITY_TABLES = ("activity_hourly", "activity_daily")
+UPSERT_ACTIVITY_SQL = {
+    table: f"""
+        INSERT INTO {table} (chat_id, bucket, user_id, message_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(chat_id, bucket, user_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count
+    """
+    for table in ACTIVITY_TABLES
+}
+SELECT_ACTIVITY_VOLUME_SQL = {
+    table: f"SELECT bucket, SUM(message_count) FROM {table} WHERE chat_id = ? AND bucket >= ? GROUP BY bucket"
+    for table in ACTIVITY_TABLES
+}
+SELECT_ACTIVITY_USERS_SQL = {
+    table: f"SELECT COUNT(DISTINCT user_id) FROM {table} WHERE chat_id = ? AND bucket >= ?"
+    for table in ACTIVITY_TABLES
+}
+SELECT_ACTIVITY_TOP_SQL = {
+    table: f"""
+        SELECT a.user_id, u.username, SUM(a.message_count) AS total
+        FROM {table} AS a
+        LEFT JOIN chat_users AS u ON u.chat_id = a.chat_id AND u.user_id = a.user_id
+        WHERE a.chat_id = ? AND a.bucket >= ?
+        GROUP BY a.user_id
+        ORDER BY total DESC
+        LIMIT ?
+    """
+    for table in ACTIVITY_TABLES
+}
+DELETE_ACTIVITY_SQL = {table: f"DELETE FROM {table} WHERE chat_id = ? AND bucket < ?" for table in ACTIVITY_TABLES}
+SELECT_CONVERSATION_STATE_SQL = "SELECT data FROM conversation_state WHERE kind = ? AND key = ? AND updated_at >= ?"
+UPSERT_CONVERSATION_STATE_SQL = """
+    INSERT INTO conversation_state (kind, key, data, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+"""
+DELETE_CONVERSATION_STATE_SQL = "DELETE FROM conversation_state WHERE kind = ? AND key = ?"
+PURGE_CONVERSATION_STATE_SQL = "DELETE FROM conversation_state WHERE updated_at < ?"
+SELECT_STATE_SQL = "SELECT value FROM bot_state WHERE key = ?"
+UPSERT_STATE_SQL = "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        # Один поток — одно соединение: запросы выполняются строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.timer("db_seconds", (("op", func.__name__.lstrip("_")),)):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        if self._conn:
+            return
+        # cached_statements: повторно используем подготовленные выражения для одинакового SQL
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        self._conn = conn
+        self._migrate()
+
+    def _migrate(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, script in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info("Migrating database schema from version %s to %s.", version, target)
+            if callable(script):
+                self._conn.execute("BEGIN")
+                try:
+                    script(self._conn)
+                    self._conn.execute(f"PRAGMA user_version = {target}")
+                    self._conn.commit()
+                except Exception:
+                    self._conn.rollback()
+                    raise
+            else:
+                self._conn.executescript(f"BEGIN; {script} PRAGMA user_version = {target}; COMMIT;")
+            version = target
+
+    def _close(self):
+        if self._conn:
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+            self._conn = None
+
+    async def open(self):
+        await self.run(self._open)
+        logger.info("Database initialized successfully at %s (WAL mode).", self.path)
+
+    async def close(self):
+        try:
+            await self.run(self._close)
+        finally:
+            self._executor.shutdown(wait=True)
+        logger.info("Database connection closed.")
+
+    def _get_message_count(self, chat_id, user_id):
+        row = self._conn.execute(SELECT_MESSAGE_COUNT_SQL, (chat_id, user_id)).fetchone()
+        return row[0] if row else 0
+
+    async def get_message_count(self, chat_id, user_id):
+        return await self.run(self._get_message_count, chat_id, user_id)
+
+    def _add_message_counts(self, rows, state, activity):
+        with self._conn:
+            self._conn.executemany(UPSERT_COUNTS_SQL, rows)
+            if state:
+                self._conn.executemany(UPSERT_STATE_SQL, state.items())
+            if activity:
+                for table, activity_rows in activity.items():
+                    self._conn.executemany(UPSERT_ACTIVITY_SQL[table], activity_rows)
+            # Итоговые значения после сброса нужны таблице лидеров
+            return [
+                (chat_id, user_id, username, self._conn.execute(SELECT_MESSAGE_COUNT_SQL, (chat_id, user_id)).fetchone()[0])
+                for chat_id, user_id, username, _ in rows
+            ]
+
+    async def add_message_counts(self, rows, state=None, activity=None):
+        # Служебное состояние (bot_state) и сводки активности ({таблица: [(chat_id, bucket,
+        # user_id, прирост)]}) пишутся в той же транзакции, что и счётчики.
+        # Возвращает список (chat_id, user_id, username, message_count) с новыми значениями.
+        return await self.run(self._add_message_counts, rows, state, activity)
+
+    def _add_backfill_counts(self, rows, activity, state):
+        with self._conn:
+            self._conn.executemany(UPSERT_BACKFILL_COUNTS_SQL, rows)
+            for table, activity_rows in activity.items():
+                self._conn.executemany(UPSERT_ACTIVITY_SQL[table], activity_rows)
+            self._conn.executemany(UPSERT_STATE_SQL, state.items())
+
+    async def add_backfill_counts(self, rows, activity, state):
+        # Пакет загружаемой истории: счётчики, сводки активности и отметка о прогрессе
+        # в bot_state пишутся одной транзакцией
+        await self.run(self._add_backfill_counts, rows, activity, state)
+
+    def _get_top_users(self, chat_id, limit):
+        return self._conn.execute(SELECT_TOP_USERS_SQL, (chat_id, limit)).fetchall()
+
+    async def get_top_users(self, chat_id, limit):
+        return await self.run(self._get_top_users, chat_id, limit)
+
+    def _get_activity_stats(self, chat_id, table, since, limit):
+        volume = self._conn.execute(SELECT_ACTIVITY_VOLUME_SQL[table], (chat_id, since)).fetchall()
+        active_users = self._conn.execute(SELECT_ACTIVITY_USERS_SQL[table], (chat_id, since)).fetchone()[0]
+        top_rows = self._conn.execute(SELECT_ACTIVITY_TOP_SQL[table], (chat_id, since, limit)).fetchall()
+        return volume, active_users, top_rows
+
+    async def get_activity_stats(self, chat_id, table, since, limit):
+        # Возвращает ([(bucket, сообщений)], число активных участников, [(user_id, username, сообщений)])
+        return await self.run(self._get_activity_stats, chat_id, table, since, limit)
+
+    def _compact_activity(self, chat_ids, cutoffs):
+        deleted = 0
+        with self._conn:
+            for table, cutoff in cutoffs.items():
+                for chat_id in chat_ids:
+                    deleted += self._conn.execute(DELETE_ACTIVITY_SQL[table], (chat_id, cutoff)).rowcount
+        return deleted
+
+    async def compact_activity(self, chat_ids, cutoffs):
+        # cutoffs: {таблица сводки: первый сохраняемый bucket}
+        return await self.run(self._compact_activity, chat_ids, cutoffs)
+
+    def _load_conversation_state(self, kind, key, since):
+        row = self._conn.execute(SELECT_CONVERSATION_STATE_SQL, (kind, key, since)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def load_conversation_state(self, kind, key, since):
+        # Состояние, которое не менялось с момента since, считается истёкшим
+        return await self.run(self._load_conversation_state, kind, key, since)
+
+    def _save_conversation_state(self, kind, key, data):
+        with self._conn:
+            if data:
+                self._conn.execute(
+                    UPSERT_CONVERSATION_STATE_SQL, (kind, key, json.dumps(data, ensure_ascii=False), int(time.time()))
+                )
+            else:
+                self._conn.execute(DELETE_CONVERSATION_STATE_SQL, (kind, key))
+
+    async def save_conversation_state(self, kind, key, data):
+        # Пустой словарь удаляет запись
+        await self.run(self._save_conversation_state, kind, key, data)
+
+    def _purge_conversation_state(self, before):
+        with self._conn:
+            return self._conn.execute(PURGE_CONVERSATION_STATE_SQL, (before,)).rowcount
+
+    async def purge_conversation_state(self, before):
+        return await self.run(self._purge_conversation_state, before)
+
+    def _total_changes(self):
+        return self._conn.total_changes
+
+    async def total_changes(self):
+        # Сколько строк изменено через это соединение с момента открытия
+        return await self.run(self._total_changes)
+
+    def _get_state(self, key):
+        row = self._conn.execute(SELECT_STATE_SQL, (key,)).fetchone()
+        return row[0] if row else None
+
+    async def get_state(self, key):
+        return await self.run(self._get_state, key)
+
+    def _set_state(self, key, value):
+        with self._conn:
+            self._conn.execute(UPSERT_STATE_SQL, (key, value))
+
+    async def set_state(self, key, value):
+        await self.run(self._set_state, key, value)
+
+db = Database(DB_PATH)
+
+# --- Ранги по количеству сообщений ---
+# Пороги рангов в порядке возрастания; ранг ищется бинарным поиском по порогам
+RANK_TIERS = (
+    (0, "Странник Эфира"),
+    (150, "Адепт Небес"),
+    (300, "Мастер Дао"),
+    (600, "Архонт Света"),
+    (1200, "Повелитель Стихий"),
+    (2400, "Бессмертный Пангу"),
+)
+RANK_THRESHOLDS = [threshold for threshold, _ in RANK_TIERS]
+# Счётчик растёт на единицу, поэтому новый ранг получен ровно при достижении порога
+RANK_UP_COUNTS = frozenset(RANK_THRESHOLDS[1:])
+RANK_UP_ANNOUNCE = os.getenv("RANK_UP_ANNOUNCE", "1") == "1"
 
-# --- Функция для получения ранга по количеству сообщений ---
 def get_rank(message_count):
-    if message_count >= 2400:
-        return "Бессмертный Пангу"
-    elif message_count >= 1200:
-        return "Повелитель Стихий"
-    elif message_count >= 600:
-        return "Архонт Света"
-    elif message_count >= 300:
-        return "Мастер Дао"
-    elif message_count >= 150:
-        return "Адепт Небес"
-    else:
-        return "Странник Эфира"
+    return RANK_TIERS[max(bisect_right(RANK_THRESHOLDS, message_count) - 1, 0)][1]
+
+# --- Сводки активности по часам и суткам ---
+# Вместе со счётчиками копятся приросты по (chat_id, user_id, час) и при сбросе
+# записываются в activity_hourly и activity_daily. Старые интервалы периодически
+# удаляются: почасовые нужны только для /stats day, посуточные — для week и month.
+ACTIVITY_UTC_OFFSET = int(os.getenv("ACTIVITY_UTC_OFFSET", "3"))  # часов; по умолчанию МСК
+ACTIVITY_HOURLY_RETENTION_DAYS = int(os.getenv("ACTIVITY_HOURLY_RETENTION_DAYS", "14"))
+ACTIVITY_DAILY_RETENTION_DAYS = int(os.getenv("ACTIVITY_DAILY_RETENTION_DAYS", "400"))
+ACTIVITY_COMPACT_INTERVAL = float(os.getenv("ACTIVITY_COMPACT_INTERVAL", "3600"))
+
+def activity_hour(timestamp):
+    return (int(timestamp) + ACTIVITY_UTC_OFFSET * 3600) // 3600
+
+class ActivityCompactor:
+    def __init__(self, database, interval):
+        self.database = database
+        self.interval = interval
+        self._task = None
+
+    async def compact(self):
+        current_hour = activity_hour(time.time())
+        cutoffs = {
+            "activity_hourly": current_hour - ACTIVITY_HOURLY_RETENTION_DAYS * 24,
+            "activity_daily": current_hour // 24 - ACTIVITY_DAILY_RETENTION_DAYS,
+        }
+        # Удаление идёт по первичному ключу внутри каждого чата, а не сканированием таблицы
+        deleted = await self.database.compact_activity(sorted(settings.discussion_groups), cutoffs)
+        if deleted:
+            logger.info("Removed %s expired activity rollup rows.", deleted)
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error("Failed to compact activity rollups: %s", e, exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._compact_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+activity_compactor = ActivityCompactor(db, ACTIVITY_COMPACT_INTERVAL)
+
+# --- Отложенная (write-behind) запись счётчиков сообщений ---
+# Инкременты копятся в памяти по (chat_id, user_id) и сбрасываются в базу одной транзакцией
+# по таймеру или при достижении порога, а не отдельным commit на каждое сообщение.
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "2.0"))
+COUNTER_FLUSH_THRESHOLD = int(os.getenv("COUNTER_FLUSH_THRESHOLD", "200"))
+
+class MessageCounter:
+    def __init__(self, database, flush_interval, flush_threshold):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = {}   # (chat_id, user_id) -> [прирост, username]
+        self._inflight = {}  # инкременты, которые сейчас записываются в базу
+        self._activity = {}  # (chat_id, user_id, час) -> прирост для сводок активности
+        self._pending_messages = 0
+        self._lock = None
+        self._task = None
+        self._flush_task = None
+        self._state_sources = {}  # ключ bot_state -> функция, возвращающая текущее значение
+        self._saved_state = {}
+        self._flush_listeners = []
+
+    def increment(self, chat_id, user_id, username, timestamp=None):
+        # timestamp — время отправки сообщения; определяет интервал в сводках активности
+        key = (chat_id, user_id)
+        entry = self._pending.get(key)
+        if entry:
+            entry[0] += 1
+            entry[1] = username
+        else:
+            self._pending[key] = [1, username]
+        activity_key = (chat_id, user_id, activity_hour(time.time() if timestamp is None else timestamp))
+        self._activity[activity_key] = self._activity.get(activity_key, 0) + 1
+        self._pending_messages += 1
+        if self._pending_messages >= self.flush_threshold and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def add_flush_listener(self, listener):
+        # listener(totals) вызывается после каждого успешного сброса со списком
+        # (chat_id, user_id, username, message_count)
+        self._flush_listeners.append(listener)
+
+    @property
+    def pending_messages(self):
+        return self._pending_messages
+
+    def track_state(self, key, source):
+        self._state_sources[key] = source
+
+    def _changed_state(self):
+        state = {}
+        for key, source in self._state_sources.items():
+            value = source()
+            if value is not None and str(value) != self._saved_state.get(key):
+                state[key] = str(value)
+        return state
+
+    def pending(self, chat_id, user_id):
+        # Запись в базу и чтение идут через один поток по очереди, поэтому пока
+        # сброс не завершён, его инкременты ещё не видны в базе и учитываются здесь
+        key = (chat_id, user_id)
+        entry = self._pending.get(key)
+        inflight = self._inflight.get(key)
+        return (entry[0] if entry else 0) + (inflight[0] if inflight else 0)
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            state = self._changed_state()
+            if not self._pending and not state:
+                return
+            batch = self._inflight = self._pending
+            self._pending = {}
+            self._pending_messages = 0
+            activity = self._activity
+            self._activity = {}
+
+            rows = [(chat_id, user_id, username, count) for (chat_id, user_id), (count, username) in batch.items()]
+            daily = {}
+            for (chat_id, user_id, hour), count in activity.items():
+                day_key = (chat_id, hour // 24, user_id)
+                daily[day_key] = daily.get(day_key, 0) + count
+            activity_rows = {
+                "activity_hourly": [(chat_id, hour, user_id, count) for (chat_id, user_id, hour), count in activity.items()],
+                "activity_daily": [key + (count,) for key, count in daily.items()],
+            }
+            try:
+                totals = await self.database.add_message_counts(rows, state, activity_rows)
+            except Exception as e:
+                logger.error("Failed to flush message counts for %s users: %s", len(rows), e, exc_info=True)
+                # Возвращаем несохранённые инкременты обратно, чтобы не потерять их
+                for key, (count, username) in batch.items():
+                    entry = self._pending.setdefault(key, [0, username])
+                    entry[0] += count
+                    self._pending_messages += count
+                for key, count in activity.items():
+                    self._activity[key] = self._activity.get(key, 0) + count
+                return
+            finally:
+                self._inflight = {}
+
+            self._saved_state.update(state)
+            if rows:
+                logger.info("Flushed %s message increments for %s users.", sum(r[3] for r in rows), len(rows))
+            # Транзакция уже зафиксирована: ошибка слушателя не должна вернуть пакет в очередь
+            for listener in self._flush_listeners:
+                try:
+                    listener(totals)
+                except Exception as e:
+                    logger.error("Flush listener %r failed: %s", listener, e, exc_info=True)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+message_counter = MessageCounter(db, COUNTER_FLUSH_INTERVAL, COUNTER_FLUSH_THRESHOLD)
+metrics.collect("counter_pending_messages", "gauge", "Message increments not yet flushed to the database.", lambda: message_counter.pending_messages, writer_only=True)
+
+# --- Таблица лидеров (топ-K самых активных участников) ---
+# Для каждой группы в памяти хранятся только K лучших участников. Счётчики лишь растут, поэтому
+# достаточно предлагать таблице каждого, чей счётчик изменился: после сброса
+# счётчиков топ остаётся точным без сортировки всей таблицы users.
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "50"))
+TOP_DEFAULT_LIMIT = 10
+
+class Leaderboard:
+    def __init__(self, size):
+        self.size = size
+        self._entries = {}  # user_id -> [message_count, username]
+        self._min_count = 0
+
+    def _update_min(self):
+        self._min_count = min(entry[0] for entry in self._entries.values()) if len(self._entries) >= self.size else 0
+
+    def load(self, rows):
+        self._entries = {user_id: [message_count, username] for user_id, username, message_count in rows}
+        self._update_min()
+
+    def offer(self, user_id, username, message_count):
+        entry = self._entries.get(user_id)
+        if entry:
+            was_min = entry[0] == self._min_count
+            entry[0] = message_count
+            entry[1] = username
+            if was_min:
+                self._update_min()
+            return
+        if len(self._entries) >= self.size:
+            if message_count <= self._min_count:
+                return
+            weakest = min(self._entries, key=lambda uid: self._entries[uid][0])
+            del self._entries[weakest]
+        self._entries[user_id] = [message_count, username]
+        self._update_min()
+
+    def top(self, limit, pending=None):
+        # pending(user_id) добавляет ещё не сброшенные инкременты
+        rows = [
+            (user_id, username, message_count + (pending(user_id) if pending else 0))
+            for user_id, (message_count, username) in self._entries.items()
+        ]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+leaderboards = {}  # chat_id -> Leaderboard, заполняется в main()
+
+def update_leaderboards(totals):
+    for chat_id, user_id, username, message_count in totals:
+        board = leaderboards.get(chat_id)
+        if board:
+            board.offer(user_id, username, message_count)
+
+message_counter.add_flush_listener(update_leaderboards)
+
+# --- Кэш для команды /rank ---
+# Ограниченный по размеру LRU-кэш с TTL: (chat_id, user_id) -> (message_count, rank) из базы.
+# После каждого сброса счётчиков закэшированные значения обновляются, а ещё не
+# сброшенные инкременты добавляются при чтении, поэтому ответ никогда не устаревает.
+RANK_CACHE_SIZE = int(os.getenv("RANK_CACHE_SIZE", "10000"))
+RANK_CACHE_TTL = float(os.getenv("RANK_CACHE_TTL", "600"))
+
+class RankCache:
+    def __init__(self, database, max_size, ttl):
+        self.database = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (chat_id, user_id) -> (message_count, rank, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, key, message_count):
+        self._entries[key] = (message_count, get_rank(message_count), time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry and entry[2] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+        self.misses += 1
+        message_count = await self.database.get_message_count(chat_id, user_id)
+        self._put(key, message_count)
+        return message_count, get_rank(message_count)
+
+    def on_flushed(self, totals):
+        for chat_id, user_id, _, message_count in totals:
+            key = (chat_id, user_id)
+            if key in self._entries:
+                self._put(key, message_count)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+rank_cache = RankCache(db, RANK_CACHE_SIZE, RANK_CACHE_TTL)
+metrics.collect("rank_cache_hits", "counter", "Rank cache hits.", lambda: rank_cache.hits, writer_only=True)
+metrics.collect("rank_cache_misses", "counter", "Rank cache misses.", lambda: rank_cache.misses, writer_only=True)
+message_counter.add_flush_listener(rank_cache.on_flushed)
+
+# --- Защита от флуда ---
+# Частота сообщений каждого участника (чат, пользователь) оценивается скользящим окном
+# по двум счётчикам: сообщения текущего окна плюс доля сообщений предыдущего,
+# пропорциональная ещё не вышедшей из окна части. Обновление — O(1), на участника
+# хранится одна короткая запись, а число записей ограничено FLOOD_TRACKED_MAX
+# (первыми вытесняются дольше всех молчавшие). Сообщения сверх FLOOD_MAX_MESSAGES
+# за FLOOD_WINDOW секунд не засчитываются: не попадают в MessageCounter, сводки
+# активности и базу и не приближают новый ранг. Отброшенные сообщения тоже входят
+# в частоту, так что непрерывный флуд не засчитывается, пока участник не замедлится.
+FLOOD_MAX_MESSAGES = int(os.getenv("FLOOD_MAX_MESSAGES", "30"))  # 0 — защита выключена
+FLOOD_WINDOW = int(os.getenv("FLOOD_WINDOW", "60"))  # секунд
+FLOOD_TRACKED_MAX = int(os.getenv("FLOOD_TRACKED_MAX", "50000"))
+# Нарушители для /flood: не больше FLOOD_REPORT_SIZE записей за последние FLOOD_REPORT_TTL секунд
+FLOOD_REPORT_SIZE = int(os.getenv("FLOOD_REPORT_SIZE", "200"))
+FLOOD_REPORT_TTL = int(os.getenv("FLOOD_REPORT_TTL", str(24 * 3600)))
+# Предупреждать ли в чате, что сообщения перестали засчитываться (один раз за всплеск).
+# По умолчанию выключено: во время рейда со многих аккаунтов бот сам добавлял бы сообщений
+FLOOD_WARN = os.getenv("FLOOD_WARN", "0") == "1"
+
+class FloodDetector:
+    def __init__(self, max_messages, window, max_tracked, report_size, report_ttl):
+        self.max_messages = max_messages
+        self.window = window
+        self.max_tracked = max_tracked
+        self.report_size = report_size
+        self.report_ttl = report_ttl
+        # (chat_id, user_id) -> [начало текущего окна, сообщений в нём, в предыдущем окне, отброшено подряд]
+        self._windows = OrderedDict()
+        # (chat_id, user_id) -> [имя, отброшено всего, время последнего отброшенного]
+        self._offenders = OrderedDict()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._windows)
+
+    def check(self, chat_id, user_id, username, timestamp):
+        # 0 — сообщение засчитывается, иначе номер отброшенного сообщения в текущем всплеске
+        if self.max_messages <= 0:
+            return 0
+        key = (chat_id, user_id)
+        window_start = timestamp - timestamp % self.window
+        entry = self._windows.pop(key, None)
+        if entry is None:
+            entry = [window_start, 0, 0, 0]
+        elif window_start > entry[0]:
+            # Текущее окно становится предыдущим, только если новое идёт сразу за ним
+            entry[2] = entry[1] if window_start - entry[0] == self.window else 0
+            entry[0] = window_start
+            entry[1] = 0
+        self._windows[key] = entry
+        self._evict(window_start)
+
+        entry[1] += 1
+        # Сообщения с опозданием (timestamp из прошлого окна) считаются в текущем
+        elapsed = min(max(timestamp - entry[0], 0), self.window)
+        rate = entry[1] + entry[2] * (self.window - elapsed) / self.window
+        if rate <= self.max_messages:
+            entry[3] = 0
+            return 0
+
+        entry[3] += 1
+        self.dropped += 1
+        self._report(key, username, timestamp)
+        if entry[3] == 1:
+            logger.warning(
+                "User %s (%s) in chat %s sent more than %s messages in %s s; not counting further messages.",
+                user_id, username, chat_id, self.max_messages, self.window
+            )
+        return entry[3]
+
+    def _evict(self, window_start):
+        # Порядок записей — порядок последних сообщений, поэтому в начале лежат те,
+        # чьё предыдущее окно уже целиком вышло из скользящего и ничего не значит
+        while self._windows:
+            key, entry = next(iter(self._windows.items()))
+            if entry[0] >= window_start - self.window and len(self._windows) <= self.max_tracked:
+                break
+            del self._windows[key]
+
+    def _report(self, key, username, timestamp):
+        record = self._offenders.pop(key, None) or [username, 0, 0]
+        record[0] = username
+        record[1] += 1
+        record[2] = timestamp
+        self._offenders[key] = record
+        while len(self._offenders) > self.report_size:
+            self._offenders.popitem(last=False)
+
+    def offenders(self, chat_id, now):
+        # [(user_id, имя, отброшено, время последнего отброшенного)], сначала недавние
+        since = now - self.report_ttl
+        while self._offenders and next(iter(self._offenders.values()))[2] < since:
+            self._offenders.popitem(last=False)
+        return [
+            (user_id, username, dropped, last_dropped)
+            for (offender_chat_id, user_id), (username, dropped, last_dropped) in reversed(self._offenders.items())
+            if offender_chat_id == chat_id
+        ]
+
+flood_detector = FloodDetector(FLOOD_MAX_MESSAGES, FLOOD_WINDOW, FLOOD_TRACKED_MAX, FLOOD_REPORT_SIZE, FLOOD_REPORT_TTL)
+metrics.collect("flood_dropped_messages", "counter", "Messages not counted because of flood protection.", lambda: flood_detector.dropped, writer_only=True)
+metrics.collect("flood_tracked_users", "gauge", "Chat members tracked by flood protection.", lambda: len(flood_detector), writer_only=True)
+
+# --- Планировщик исходящих запросов к Telegram ---
+# Подключается к Application как rate limiter: все вызовы Bot API проходят через
+# общий и поканальный «ведра токенов», ответы на команды обслуживаются раньше
+# фоновых сообщений (приоритет передаётся через rate_limit_args), а при 429
+# RetryAfter запрос повторяется после указанной паузы, а не теряется.
+# При WEBHOOK_WORKERS > 1 у каждого процесса свои «вёдра», поэтому лимиты делятся
+# между процессами поровну, чтобы в сумме не превысить ограничения Telegram.
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "1")))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30")) / WEBHOOK_WORKERS              # сообщений в секунду на бота
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1")) / WEBHOOK_WORKERS             # в секунду на личный чат
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE_PER_MINUTE", "20")) / 60 / WEBHOOK_WORKERS  # в секунду на группу
+SEND_GROUP_BURST = max(1, int(os.getenv("SEND_GROUP_BURST", "3")) // WEBHOOK_WORKERS)
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+# HTTP/2 мультиплексирует запросы в одном соединении, если установлен пакет h2
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "2" if importlib.util.find_spec("h2") else "1.1")
+
+SEND_PRIORITY_HIGH = 0  # ответы на команды (по умолчанию)
+SEND_PRIORITY_LOW = 1   # объявления о рангах, комментарии к постам канала
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []  # куча (приоритет, порядковый номер, future)
+        self._seq = 0
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def idle(self):
+        self._refill()
+        return not self._waiters and self._tokens >= self.capacity
+
+    async def acquire(self, priority):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._schedule()
+        await future
+
+    def _schedule(self):
+        if self._timer is None and self._waiters:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # ожидание отменено
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        self._schedule()
+
+class SendScheduler(BaseRateLimiter):
+    def __init__(self):
+        self._global_bucket = None
+        self._chat_buckets = {}  # chat_id -> TokenBucket
+        self._paused_until = 0.0
+        # Личность бота из bot_state: первый getMe при старте отвечается без запроса к API
+        self.cached_identity = None
+
+    async def initialize(self):
+        self._global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+
+    async def shutdown(self):
+        self._chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 1024:
+                # Убираем вёдра чатов, в которые давно ничего не отправлялось
+                for key in [key for key, value in self._chat_buckets.items() if value.idle()]:
+                    del self._chat_buckets[key]
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(SEND_PRIVATE_RATE, 1)
+            else:
+                bucket = TokenBucket(SEND_GROUP_RATE, SEND_GROUP_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == "getMe" and self.cached_identity is not None:
+            identity, self.cached_identity = self.cached_identity, None
+            return identity
+        priority = SEND_PRIORITY_HIGH if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            # Ограничиваются только отправки в чаты; служебные вызовы (getMe, setWebhook) идут сразу
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire(priority)
+                await self._global_bucket.acquire(priority)
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            try:
+                with metrics.timer("api_seconds", (("method", endpoint),)):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.inc("errors_total", (("where", "api_retry_after"),))
+                if attempt == SEND_MAX_RETRIES:
+                    logger.error("Flood limit hit for %s to chat %s, giving up after %s retries.", endpoint, chat_id, SEND_MAX_RETRIES)
+                    raise
+                retry_after = e.retry_after
+                # Telegram просит подождать: приостанавливаем все отправки на это время
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+                logger.warning("Flood limit hit for %s to chat %s, retrying in %ss (attempt %s/%s).", endpoint, chat_id, retry_after, attempt + 1, SEND_MAX_RETRIES)
 
 # --- Функция для обработки пересланных постов в дискуссионной группе ---
 async def handle_forwarded_post_in_discussion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Received an update in discussion group for forwarded message: {update.update_id}")
+    logger.info("Received an update in discussion group for forwarded message: %s", update.update_id)
 
     message = update.message
-    if not message:
-        logger.info("Update is not a message in discussion group (forwarded). Skipping.")
-        return
-
-    current_chat_id = str(message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored forwarded message from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = message.chat.id
 
     if message.forward_from_chat and message.forward_from_chat.type == "channel":
-        forwarded_from_channel_id = str(message.forward_from_chat.id)
-        expected_channel_id = os.getenv("CHANNEL_ID")
+        forwarded_from_channel_id = message.forward_from_chat.id
+        expected_channel_id = settings.group_channels.get(current_chat_id)
 
-        logger.info(f"Detected forwarded message from channel {forwarded_from_channel_id} in discussion group. Expected channel: {expected_channel_id}")
+        logger.info("Detected forwarded message from channel %s in discussion group. Expected channel: %s", forwarded_from_channel_id, expected_channel_id)
 
-        if expected_channel_id and forwarded_from_channel_id == expected_channel_id:
+        if expected_channel_id is not None and forwarded_from_channel_id == expected_channel_id:
             message_to_reply_id = message.message_id
             try:
                 await context.bot.send_message(
-                    chat_id=discussion_group_id,
+                    chat_id=current_chat_id,
                     text="Ждем Edem PW! 🚀",
-                    reply_to_message_id=message_to_reply_id
+                    reply_to_message_id=message_to_reply_id,
+                    rate_limit_args=SEND_PRIORITY_LOW
                 )
-                logger.info(f"Successfully commented on forwarded post {message_to_reply_id} in discussion group {discussion_group_id} from channel {forwarded_from_channel_id}")
+                logger.info("Successfully commented on forwarded post %s in discussion group %s from channel %s", message_to_reply_id, current_chat_id, forwarded_from_channel_id)
             except Exception as e:
-                logger.error(f"Failed to send message to discussion group {discussion_group_id}: {e}")
+                logger.error("Failed to send message to discussion group %s: %s", current_chat_id, e)
         else:
-            logger.info(f"Ignored forwarded message from channel {forwarded_from_channel_id}, not the expected source channel.")
+            logger.info("Ignored forwarded message from channel %s, not the expected source channel.", forwarded_from_channel_id)
     else:
         logger.info("Message in discussion group is not a forwarded message from a channel. Skipping.")
 
 # --- Функция для подсчёта сообщений пользователей в группе ---
+# Сервисные сообщения не учитываются в счётчиках
+SERVICE_MESSAGE_TYPES = frozenset(("new_chat_members", "left_chat_member", "pinned_message"))
+
 async def count_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not message.from_user:
         logger.info("Update is not a message or has no user in count_messages. Skipping.")
         return
-
-    current_chat_id = str(message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored message for counting from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}. Message text: '{message.text[:50] if message.text else 'N/A'}'")
+    # Сообщения от имени канала или анонимного администратора приходят от служебных
+    # пользователей (Channel_Bot, GroupAnonymousBot) и не принадлежат участнику
+    if message.sender_chat:
+        logger.info("Skipping message count for message sent on behalf of chat %s", message.sender_chat.id)
         return
 
+    current_chat_id = message.chat.id
+
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
 
@@ -145,77 +1228,140 @@ async def count_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif message.animation: # Добавлено для гифок
         message_type = "animation"
 
-    logger.info(f"Processing message for counting from user {user_id} ({username}), type: {message_type}, chat: {current_chat_id}")
+    logger.info("Processing message for counting from user %s (%s), type: %s, chat: %s", user_id, username, message_type, current_chat_id)
 
-    if message_type in ["new_chat_members", "left_chat_member", "pinned_message"]:
-        logger.info(f"Skipping message count for service message type: {message_type}")
+    if message_type in SERVICE_MESSAGE_TYPES:
+        logger.info("Skipping message count for service message type: %s", message_type)
         return
 
-    conn = None
     try:
-        conn = sqlite3.connect('/app/bot.db', check_same_thread=False)
-        c = conn.cursor()
-
-        c.execute("SELECT message_count FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-
-        if result:
-            message_count = result[0] + 1
-            new_rank = get_rank(message_count)
-            c.execute(
-                "UPDATE users SET message_count = ?, rank = ?, username = ? WHERE user_id = ?",
-                (message_count, new_rank, username, user_id)
-            )
-        else:
-            message_count = 1
-            new_rank = get_rank(message_count)
-            c.execute(
-                "INSERT INTO users (user_id, username, message_count, rank) VALUES (?, ?, ?, ?)",
-                (user_id, username, message_count, new_rank)
-            )
+        # Новое число сообщений нужно только для объявлений о рангах
+        message_count, flood = await counter_service.count(
+            current_chat_id, user_id, username, RANK_UP_ANNOUNCE, int(message.date.timestamp())
+        )
+    except Exception as e:
+        logger.error("Failed to count message from user %s in chat %s: %s", user_id, current_chat_id, e, exc_info=True)
+        return
+    if flood:
+        logger.info("Skipping message count for user %s (%s) in chat %s: flood", user_id, username, current_chat_id)
+        # Предупреждаем только о первом отброшенном сообщении всплеска
+        if flood == 1 and FLOOD_WARN:
+            try:
+                await context.bot.send_message(
+                    chat_id=current_chat_id,
+                    text=f"⚠️ {username}, слишком много сообщений подряд — пока они не засчитываются в ранг.",
+                    reply_to_message_id=message.message_id,
+                    rate_limit_args=SEND_PRIORITY_LOW
+                )
+            except Exception as e:
+                logger.error("Failed to send flood warning to user %s in chat %s: %s", user_id, current_chat_id, e, exc_info=True)
+        return
+    logger.info("Queued message count increment for user %s (%s) in chat %s", user_id, username, current_chat_id)
 
-        conn.commit()
-        logger.info(f"Updated message count for user {user_id} ({username}): {message_count}, rank: {new_rank} in chat {current_chat_id}")
+    if message_count not in RANK_UP_COUNTS:
+        return
+    new_rank = get_rank(message_count)
+    logger.info("User %s (%s) reached rank %s with %s messages in chat %s", user_id, username, new_rank, message_count, current_chat_id)
+    try:
+        await context.bot.send_message(
+            chat_id=current_chat_id,
+            text=f"🎉 {username} получает новый ранг: {new_rank}!",
+            reply_to_message_id=message.message_id,
+            rate_limit_args=SEND_PRIORITY_LOW
+        )
     except Exception as e:
-        logger.error(f"Failed to update message count for user {user_id} in chat {current_chat_id}: {e}", exc_info=True)
-    finally:
-        if conn:
-            conn.close()
+        logger.error("Failed to announce rank-up for user %s in chat %s: %s", user_id, current_chat_id, e, exc_info=True)
 
 # --- Функция для обработки сообщений в личных чатах ---
-async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    # Этот обработчик должен быть после handle_random_range,
-    # т.к. handle_random_range использует user_data
+async def handle_private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Текст в личке — либо ответ на запрос /random, либо обычное сообщение
     if context.user_data.get("awaiting_random_range", False):
-        logger.info(f"Ignored private message from chat_id {current_chat_id}, awaiting random range.")
-        return
+        await handle_random_range(update, context)
+    else:
+        await handle_private_message(update, context)
 
-    logger.info(f"Received private message from chat_id {current_chat_id}. Message: '{update.message.text[:50] if update.message.text else 'N/A'}'")
+async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_chat_id = str(update.message.chat.id)
+    logger.info("Received private message from chat_id %s. Message: '%.50s'", current_chat_id, update.message.text or 'N/A')
 
     try:
         await update.message.reply_text(
             "Привет! Я бот PWDarksearch by PWISMYLIFE. Используй /help, чтобы узнать, что я умею."
         )
-        logger.info(f"Sent welcome message to user in chat_id {current_chat_id}")
+        logger.info("Sent welcome message to user in chat_id %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send welcome message in chat_id {current_chat_id}: {e}")
+        logger.error("Failed to send welcome message in chat_id %s: %s", current_chat_id, e)
+
+# --- Тексты постоянных ответов ---
+START_TEXT = (
+    "Привет! Я бот PWDarksearch by PWISMYLIFE. Я могу помочь с информацией, рангами и даже немного поиграть. "
+    "Используй /help, чтобы увидеть список команд."
+)
+INFO_TEXT = (
+    "Я бот, созданный для поддержки сообщества PWISMYLIFE. "
+    "Мои функции включают подсчёт сообщений, выдачу рангов, рандомайзер и предоставление полезных ссылок."
+)
+SITE_TEXT = "Наш любимый форум: https://pwismylife.com/"
+SERVERS_TEXT = (
+    "Сервера достойные для просмотра:\n\n"
+    "Edem New Born: https://edem.pw/\n"
+    "Asgard PW: https://asgard.pw/\n"
+    "Revolution PW: https://revolutionpw.online/\n"
+    "ComeBack PW: https://comeback.pw/"
+)
+PARTNERS_TEXT = (
+    "Партнерские/Каналы соратников:\n\n"
+    "RuFree News: @RuFreeNews\n"
+    "ChaoPersik Team: @chaopersikpw\n"
+    "GastTV: @gasttv\n"
+    "Ubermench PW: @ubermensch_pw"
+)
+PRIVATE_HELP_TEXT = (
+    "📋 Доступные команды в личном чате:\n"
+    "/start - Начать взаимодействие с ботом\n"
+    "/info - Узнать информацию о боте\n"
+    "/echo <текст> - Бот повторит ваш текст\n"
+    "/random - Сгенерировать случайное число\n"
+    "/help - Показать это сообщение"
+)
+GROUP_HELP_TEXT = (
+    "📋 Доступные команды в группе:\n"
+    "/site - Показать ссылку на наш любимый форум\n"
+    "/servers - Показать список рекомендуемых серверов\n"
+    "/partners - Показать список партнёрских каналов\n"
+    "/help - Показать это сообщение\n"
+    "/ping - Проверить статус бота\n"
+    "/rank - Показать ваш текущий ранг и количество сообщений\n"
+    "/top [N] - Показать самых активных участников\n"
+    "/stats [day|week|month] - Показать активность за сутки, неделю или месяц\n"
+    "/flood - Показать, чьи сообщения не засчитаны из-за флуда"
+)
+PING_TEXT = "Бот онлайн! 🟢"
+
+# Ответы, которые не зависят ни от чего, кроме команды и типа чата:
+# (тип чата, команда) -> текст
+STATIC_REPLIES = {
+    ("private", "/start"): START_TEXT,
+    ("group", "/start"): START_TEXT,
+    ("private", "/info"): INFO_TEXT,
+    ("group", "/info"): INFO_TEXT,
+    ("private", "/help"): PRIVATE_HELP_TEXT,
+    ("group", "/help"): GROUP_HELP_TEXT,
+    ("group", "/site"): SITE_TEXT,
+    ("group", "/servers"): SERVERS_TEXT,
+    ("group", "/partners"): PARTNERS_TEXT,
+    ("group", "/ping"): PING_TEXT,
+}
 
 # --- Базовые команды ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Received /start command from user {update.effective_user.id}")
-    await update.message.reply_text(
-        "Привет! Я бот PWDarksearch by PWISMYLIFE. Я могу помочь с информацией, рангами и даже немного поиграть. "
-        "Используй /help, чтобы увидеть список команд."
-    )
+    logger.info("Received /start command from user %s", update.effective_user.id)
+    await update.message.reply_text(START_TEXT)
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Received /info command from user {update.effective_user.id}")
-    await update.message.reply_text(
-        "Я бот, созданный для поддержки сообщества PWISMYLIFE. "
-        "Мои функции включают подсчёт сообщений, выдачу рангов, рандомайзер и предоставление полезных ссылок."
-    )
+    logger.info("Received /info command from user %s", update.effective_user.id)
+    await update.message.reply_text(INFO_TEXT)
 
 async def echo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Эта команда работает только в личных чатах
@@ -228,14 +1374,14 @@ async def echo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text_to_echo = " ".join(context.args)
-    logger.info(f"Received /echo command with text: '{text_to_echo}' from user {update.effective_user.id}")
+    logger.info("Received /echo command with text: '%s' from user %s", text_to_echo, update.effective_user.id)
     await update.message.reply_text(text_to_echo)
 
 # --- Функция для команды /random ---
 async def random_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     current_chat_id = str(update.message.chat.id)
     if update.message.chat.type != "private":
-        logger.info(f"Ignored /random command from chat_id {current_chat_id}, not a private chat")
+        logger.info("Ignored /random command from chat_id %s, not a private chat", current_chat_id)
         await update.message.reply_text("Эта команда работает только в личных сообщениях.")
         return
 
@@ -244,27 +1390,22 @@ async def random_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "🎲 Введи диапазон чисел в формате <start>-<end>, например, '1-3'"
         )
         context.user_data["awaiting_random_range"] = True
-        logger.info(f"Prompted user for random range in chat_id {current_chat_id}")
+        logger.info("Prompted user for random range in chat_id %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send random range prompt in chat_id {current_chat_id}: {e}")
+        logger.error("Failed to send random range prompt in chat_id %s: %s", current_chat_id, e)
 
 # --- Функция для обработки диапазона рандомайзера ---
 async def handle_random_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Убедитесь, что это действительно приватный чат и мы ожидаем диапазон
-    if update.message.chat.type != "private" or not context.user_data.get("awaiting_random_range", False):
-        logger.info(f"Ignored message from chat_id {str(update.message.chat.id)}, not awaiting random range in private chat.")
-        return
-
     range_text = update.message.text.strip()
     current_chat_id = str(update.message.chat.id)
-    logger.info(f"Received range '{range_text}' from user in chat_id {current_chat_id}")
+    logger.info("Received range '%s' from user in chat_id %s", range_text, current_chat_id)
 
     try:
         if "-" not in range_text:
             await update.message.reply_text(
                 "❌ Неверный формат. Введи диапазон в формате <start>-<end>, например, '1-3'"
             )
-            logger.info(f"Invalid range format '{range_text}' from chat_id {current_chat_id}")
+            logger.info("Invalid range format '%s' from chat_id %s", range_text, current_chat_id)
             return
 
         start_str, end_str = map(str.strip, range_text.split("-", 1))
@@ -275,194 +1416,1128 @@ async def handle_random_range(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text(
                 "❌ Начало диапазона должно быть меньше или равно концу. Попробуй снова, например, '1-3'"
             )
-            logger.info(f"Invalid range: start {start} > end {end} from chat_id {current_chat_id}")
+            logger.info("Invalid range: start %s > end %s from chat_id %s", start, end, current_chat_id)
             return
 
         random_number = random.randint(start, end)
         await update.message.reply_text(f"🎲 Случайное число: {random_number}")
-        logger.info(f"Generated random number {random_number} for range {start}-{end} in chat_id {current_chat_id}")
+        logger.info("Generated random number %s for range %s-%s in chat_id %s", random_number, start, end, current_chat_id)
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат чисел. Используй целые числа, например, '1-3'"
         )
-        logger.info(f"Invalid number format in range '{range_text}' from chat_id {current_chat_id}")
+        logger.info("Invalid number format in range '%s' from chat_id %s", range_text, current_chat_id)
     except Exception as e:
         await update.message.reply_text("❌ Ошибка при генерации числа. Попробуй снова.")
-        logger.error(f"Failed to generate random number for range '{range_text}' in chat_id {current_chat_id}: {e}", exc_info=True)
+        logger.error("Failed to generate random number for range '%s' in chat_id %s: %s", range_text, current_chat_id, e, exc_info=True)
     finally:
-        context.user_data["awaiting_random_range"] = False
+        context.user_data.pop("awaiting_random_range", None)
 
 # --- Функции для команд в группе ---
 async def site(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored /site command from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = update.message.chat.id
 
     try:
-        await update.message.reply_text("Наш любимый форум: https://pwismylife.com/")
-        logger.info(f"Sent /site response in discussion group {discussion_group_id}")
+        await update.message.reply_text(SITE_TEXT)
+        logger.info("Sent /site response in discussion group %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send /site response in discussion group {discussion_group_id}: {e}")
+        logger.error("Failed to send /site response in discussion group %s: %s", current_chat_id, e)
 
 async def servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored /servers command from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = update.message.chat.id
 
     try:
-        await update.message.reply_text(
-            "Сервера достойные для просмотра:\n\n"
-            "Edem New Born: https://edem.pw/\n"
-            "Asgard PW: https://asgard.pw/\n"
-            "Revolution PW: https://revolutionpw.online/\n"
-            "ComeBack PW: https://comeback.pw/"
-        )
-        logger.info(f"Sent /servers response in discussion group {discussion_group_id}")
+        await update.message.reply_text(SERVERS_TEXT)
+        logger.info("Sent /servers response in discussion group %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send /servers response in discussion group {discussion_group_id}: {e}")
+        logger.error("Failed to send /servers response in discussion group %s: %s", current_chat_id, e)
 
 async def partners(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored /partners command from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = update.message.chat.id
 
     try:
-        await update.message.reply_text(
-            "Партнерские/Каналы соратников:\n\n"
-            "RuFree News: @RuFreeNews\n"
-            "ChaoPersik Team: @chaopersikpw\n"
-            "GastTV: @gasttv\n"
-            "Ubermench PW: @ubermensch_pw"
-        )
-        logger.info(f"Sent /partners response in discussion group {discussion_group_id}")
+        await update.message.reply_text(PARTNERS_TEXT)
+        logger.info("Sent /partners response in discussion group %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send /partners response in discussion group {discussion_group_id}: {e}")
+        logger.error("Failed to send /partners response in discussion group %s: %s", current_chat_id, e)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_type = update.message.chat.type
     user_id = update.effective_user.id
-    logger.info(f"Received /help command from user {user_id} in chat type {chat_type}")
+    logger.info("Received /help command from user %s in chat type %s", user_id, chat_type)
 
     if chat_type == "private":
-        await update.message.reply_text(
-            "📋 Доступные команды в личном чате:\n"
-            "/start - Начать взаимодействие с ботом\n"
-            "/info - Узнать информацию о боте\n"
-            "/echo <текст> - Бот повторит ваш текст\n"
-            "/random - Сгенерировать случайное число\n"
-            "/help - Показать это сообщение"
-        )
+        await update.message.reply_text(PRIVATE_HELP_TEXT)
     else: # Группа
-        discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-        current_chat_id = str(update.message.chat.id)
-        if not discussion_group_id or current_chat_id != discussion_group_id:
-            logger.info(f"Ignored /help command in group {current_chat_id}, not the expected discussion group {discussion_group_id}")
-            return
-
-        await update.message.reply_text(
-            "📋 Доступные команды в группе:\n"
-            "/site - Показать ссылку на наш любимый форум\n"
-            "/servers - Показать список рекомендуемых серверов\n"
-            "/partners - Показать список партнёрских каналов\n"
-            "/help - Показать это сообщение\n"
-            "/ping - Проверить статус бота\n"
-            "/rank - Показать ваш текущий ранг и количество сообщений"
-        )
-    logger.info(f"Sent /help response to user {user_id} in chat type {chat_type}")
+        await update.message.reply_text(GROUP_HELP_TEXT)
+    logger.info("Sent /help response to user %s in chat type %s", user_id, chat_type)
 
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored /ping command from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = update.message.chat.id
 
     try:
-        await update.message.reply_text("Бот онлайн! 🟢")
-        logger.info(f"Sent /ping response in discussion group {discussion_group_id}")
+        await update.message.reply_text(PING_TEXT)
+        logger.info("Sent /ping response in discussion group %s", current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send /ping response in discussion group {discussion_group_id}: {e}")
+        logger.error("Failed to send /ping response in discussion group %s: %s", current_chat_id, e)
 
 async def rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_chat_id = str(update.message.chat.id)
-    discussion_group_id = os.getenv("DISCUSSION_GROUP_ID")
-
-    if not discussion_group_id or current_chat_id != discussion_group_id:
-        logger.info(f"Ignored /rank command from chat_id {current_chat_id}, not the expected discussion group {discussion_group_id}")
-        return
+    current_chat_id = update.message.chat.id
 
     user_id = update.message.from_user.id
     username = update.message.from_user.username or update.message.from_user.first_name
 
-    conn = None
     try:
-        conn = sqlite3.connect('/app/bot.db', check_same_thread=False)
-        c = conn.cursor()
-        c.execute("SELECT message_count, rank FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-
-        if result:
-            message_count, rank = result
-            response = f"👤 Пользователь: {username}\n📊 Количество сообщений: {message_count}\n🏆 Ранг: {rank}"
-        else:
-            response = f"👤 Пользователь: {username}\n📊 Количество сообщений: 0\n🏆 Ранг: Странник Эфира"
+        message_count = await counter_service.message_count(current_chat_id, user_id)
+        user_rank = get_rank(message_count)
+        response = f"👤 Пользователь: {username}\n📊 Количество сообщений: {message_count}\n🏆 Ранг: {user_rank}"
 
         await update.message.reply_text(response)
-        logger.info(f"Sent /rank response for user {user_id} in discussion group {discussion_group_id}")
+        logger.info("Sent /rank response for user %s in discussion group %s", user_id, current_chat_id)
     except Exception as e:
-        logger.error(f"Failed to send /rank response in discussion group {discussion_group_id}: {e}", exc_info=True)
+        logger.error("Failed to send /rank response in discussion group %s: %s", current_chat_id, e, exc_info=True)
         await update.message.reply_text("❌ Ошибка при получении ранга. Попробуй позже.")
-    finally:
-        if conn:
-            conn.close()
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_chat_id = update.message.chat.id
+
+    limit = TOP_DEFAULT_LIMIT
+    if context.args:
+        try:
+            limit = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text(f"❌ Укажи число участников, например: /top {TOP_DEFAULT_LIMIT}")
+            return
+    limit = max(1, min(limit, LEADERBOARD_SIZE))
+
+    try:
+        rows = await counter_service.top(current_chat_id, limit)
+        if rows:
+            lines = [
+                f"{place}. {username or user_id} — {message_count} ({get_rank(message_count)})"
+                for place, (user_id, username, message_count) in enumerate(rows, start=1)
+            ]
+            response = f"🏆 Топ-{len(rows)} самых активных участников:\n\n" + "\n".join(lines)
+        else:
+            response = "🏆 Пока никто ничего не написал."
+
+        await update.message.reply_text(response)
+        logger.info("Sent /top %s response in discussion group %s", limit, current_chat_id)
+    except Exception as e:
+        logger.error("Failed to send /top response in discussion group %s: %s", current_chat_id, e, exc_info=True)
+
+# Период /stats: (таблица сводки, число интервалов, подпись)
+STATS_PERIODS = {
+    "day": ("activity_hourly", 24, "за последние сутки"),
+    "week": ("activity_daily", 7, "за последнюю неделю"),
+    "month": ("activity_daily", 30, "за последний месяц"),
+}
+STATS_TOP_LIMIT = 10
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_chat_id = update.message.chat.id
+
+    period = context.args[0].lower() if context.args else "day"
+    if period not in STATS_PERIODS:
+        await update.message.reply_text("❌ Укажи период: /stats day, /stats week или /stats month")
+        return
+    table, _, title = STATS_PERIODS[period]
+
+    try:
+        volume, active_users, rows = await counter_service.stats(current_chat_id, period)
+        total = sum(message_count for _, message_count in volume)
+        if total:
+            peak_bucket, peak_count = max(volume, key=lambda row: row[1])
+            # Интервалы считаются по местному времени, поэтому gmtime даёт местные часы и даты
+            if table == "activity_hourly":
+                peak = f"🕐 Самый активный час: {time.strftime('%H:00', time.gmtime(peak_bucket * 3600))} — {peak_count}"
+            else:
+                peak = f"📅 Самый активный день: {time.strftime('%d.%m', time.gmtime(peak_bucket * 86400))} — {peak_count}"
+            lines = [
+                f"{place}. {username or user_id} — {message_count}"
+                for place, (user_id, username, message_count) in enumerate(rows, start=1)
+            ]
+            response = (
+                f"📈 Статистика {title}:\n\n"
+                f"💬 Сообщений: {total}\n"
+                f"👥 Активных участников: {active_users}\n"
+                f"{peak}\n\n"
+                "🏆 Самые активные:\n" + "\n".join(lines)
+            )
+        else:
+            response = f"📈 Статистика {title}: сообщений не было."
+
+        await update.message.reply_text(response)
+        logger.info("Sent /stats %s response in discussion group %s", period, current_chat_id)
+    except Exception as e:
+        logger.error("Failed to send /stats response in discussion group %s: %s", current_chat_id, e, exc_info=True)
+        await update.message.reply_text("❌ Ошибка при получении статистики. Попробуй позже.")
+
+async def flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_chat_id = update.message.chat.id
+
+    if FLOOD_MAX_MESSAGES <= 0:
+        await update.message.reply_text("🛡 Защита от флуда выключена.")
+        return
+
+    try:
+        rows = await counter_service.flood_offenders(current_chat_id)
+        if rows:
+            # Время показываем по тому же поясу, что и /stats
+            lines = [
+                f"{place}. {username or user_id} — не засчитано {dropped}, "
+                f"последний раз в {time.strftime('%H:%M', time.gmtime(last_dropped + ACTIVITY_UTC_OFFSET * 3600))}"
+                for place, (user_id, username, dropped, last_dropped) in enumerate(rows, start=1)
+            ]
+            response = (
+                f"🚫 Флуд за последние {FLOOD_REPORT_TTL // 3600} ч. "
+                f"(больше {FLOOD_MAX_MESSAGES} сообщений за {FLOOD_WINDOW} с):\n\n" + "\n".join(lines)
+            )
+        else:
+            response = f"🛡 За последние {FLOOD_REPORT_TTL // 3600} ч. никто не флудил."
+
+        await update.message.reply_text(response)
+        logger.info("Sent /flood response in discussion group %s", current_chat_id)
+    except Exception as e:
+        logger.error("Failed to send /flood response in discussion group %s: %s", current_chat_id, e, exc_info=True)
+
+# --- Маршрутизация обновлений ---
+# В режиме INLINE_REPLIES постоянные ответы отправляются прямо в теле ответа
+# на вебхук (Telegram выполняет указанный там метод), без отдельного запроса к API.
+INLINE_REPLIES = os.getenv("INLINE_REPLIES", "0") == "1"
+
+# Вместо цепочки из десятка обработчиков с фильтрами каждое обновление
+# проходит через одну таблицу маршрутов (тип чата, команда или вид сообщения).
+# Обновления из чатов, которые бот не обслуживает, отбрасываются до вызова
+# какого-либо обработчика.
+class UpdateRouter:
+    def __init__(self, settings):
+        self.settings = settings
+        self._routes = {}  # (тип чата, "/команда" или вид сообщения) -> (обработчик, нужен ли user_data/chat_data)
+        self._inline_replies = {}  # (тип чата, "/команда") -> начало готового тела ответа
+
+    def add(self, chat_kinds, keys, callback, state=False):
+        # state=True: перед вызовом загружаются context.user_data и context.chat_data
+        for chat_kind in chat_kinds:
+            for key in keys:
+                self._routes[(chat_kind, key)] = (callback, state)
+
+    def chat_kind(self, chat_type, chat_id):
+        if chat_type == "private":
+            return "private"
+        if self.settings.is_discussion_group(chat_id):
+            return "group"
+        return None
+
+    @staticmethod
+    def command_key(text, command_length, bot_username):
+        # "/Rank@MyBot" -> "/rank"; пустая строка для команды другому боту
+        command, _, mention = text[1:command_length].partition("@")
+        if mention and mention.lower() != bot_username.lower():
+            return ""
+        return "/" + command.lower()
+
+    @classmethod
+    def message_key(cls, message, bot_username):
+        # Возвращает (ключ маршрута, аргументы команды)
+        text = message.text
+        if text and text[0] == "/" and message.entities:
+            entity = message.entities[0]
+            if entity.type == "bot_command" and entity.offset == 0:
+                return cls.command_key(text, entity.length, bot_username), text.split()[1:]
+        if message.forward_date:
+            return "forward", None
+        return ("text" if text else "other"), None
+
+    def accepts_raw(self, data):
+        # Та же проверка по сырому JSON, до построения объекта Update:
+        # False означает, что ни один обработчик это обновление не возьмёт
+        message = data.get("message")
+        if not isinstance(message, dict):
+            return False
+        chat = message.get("chat") or {}
+        chat_kind = self.chat_kind(chat.get("type"), chat.get("id"))
+        if chat_kind == "private":
+            return "text" in message
+        if chat_kind is None:
+            return False
+        return SERVICE_MESSAGE_TYPES.isdisjoint(message)
+
+    def prepare_inline_replies(self, replies):
+        # Заранее собираем тело ответа вебхука с вызовом sendMessage: при запросе
+        # остаётся только дописать chat_id (и reply_to_message_id в группах)
+        for route, text in replies.items():
+            head = json.dumps({"method": "sendMessage", "text": text}, ensure_ascii=False)[:-1]
+            self._inline_replies[route] = (head + ',"chat_id":').encode()
+
+    def inline_reply(self, data, bot_username):
+        # Тело ответа вебхука для постоянной команды или None
+        message = data["message"]
+        text = message.get("text")
+        entities = message.get("entities")
+        if not text or text[0] != "/" or not entities:
+            return None
+        entity = entities[0]
+        if entity.get("type") != "bot_command" or entity.get("offset") != 0:
+            return None
+        chat = message["chat"]
+        chat_kind = self.chat_kind(chat.get("type"), chat.get("id"))
+        head = self._inline_replies.get((chat_kind, self.command_key(text, entity.get("length", 0), bot_username)))
+        if head is None:
+            return None
+        if chat_kind == "group":
+            # Как reply_text: в группах ответ привязан к сообщению с командой
+            return head + b'%d,"reply_to_message_id":%d}' % (chat["id"], message["message_id"])
+        return head + b'%d}' % chat["id"]
+
+    def route(self, update, bot_username):
+        # Обрабатываются только новые сообщения; правки и прочие типы обновлений игнорируются
+        # Возвращает (обработчик, аргументы команды, нужен ли user_data/chat_data)
+        message = update.message
+        if not message:
+            return None, None, False
+        chat_kind = self.chat_kind(message.chat.type, message.chat.id)
+        if chat_kind is None:
+            return None, None, False
+        key, args = self.message_key(message, bot_username)
+        callback, state = self._routes.get((chat_kind, key), (None, False))
+        return callback, args, state
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        callback, args, state = self.route(update, context.bot.username)
+        if callback is None:
+            return
+        context.args = args
+        if state:
+            user = update.effective_user
+            context.conversation = await conversation_store.load(user.id if user else None, update.effective_chat.id)
+        labels = (("handler", callback.__name__),)
+        try:
+            with metrics.timer("handler_seconds", labels):
+                await callback(update, context)
+        except Exception:
+            metrics.inc("errors_total", (("where", "handler"),) + labels)
+            raise
+
+def build_router(settings):
+    router = UpdateRouter(settings)
+    everywhere = ("private", "group")
+    # Команды для любого типа чата (echo и random отвечают только в личных сообщениях)
+    router.add(everywhere, ("/start",), start_command)
+    router.add(everywhere, ("/info",), info_command)
+    router.add(everywhere, ("/echo",), echo_command)
+    router.add(("private",), ("/random",), random_command, state=True)
+    router.add(("group",), ("/random",), random_command)
+    router.add(everywhere, ("/help",), help_command)
+    # Текстовые сообщения в личных чатах (ответ на /random или приветствие)
+    router.add(("private",), ("text",), handle_private_text, state=True)
+    # Команды и сообщения для дискуссионных групп
+    router.add(("group",), ("/site",), site)
+    router.add(("group",), ("/servers",), servers)
+    router.add(("group",), ("/partners",), partners)
+    router.add(("group",), ("/ping",), ping)
+    router.add(("group",), ("/rank",), rank)
+    router.add(("group",), ("/top",), top)
+    router.add(("group",), ("/stats",), stats)
+    router.add(("group",), ("/flood",), flood)
+    router.add(("group",), ("forward",), handle_forwarded_post_in_discussion)
+    # Подсчёт сообщений в группе (не команды, не форварды; сервисные сообщения отсекает сам count_messages)
+    router.add(("group",), ("text", "other"), count_messages)
+    return router
+
+router = build_router(settings)
+if INLINE_REPLIES:
+    router.prepare_inline_replies(STATIC_REPLIES)
+
+# --- Защита от повторной доставки обновлений ---
+# Telegram повторно присылает обновление, если вебхук ответил ошибкой или не
+# уложился в таймаут. Последние update_id хранятся в кольцевом буфере
+# фиксированного размера; всё, что старше буфера или сохранённой в базе отметки,
+# считается уже обработанным.
+# Отметка хранится вместе со временем последнего роста. Если обновлений не было
+# неделю, Telegram выбирает следующий update_id случайно, поэтому отметка старше
+# UPDATE_DEDUP_MARK_TTL не используется (повторно Telegram доставляет обновления
+# не дольше суток), а update_id ниже отметки больше чем на размер буфера считается
+# началом новой последовательности, а не повтором.
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "2048"))
+UPDATE_DEDUP_MARK_TTL = int(os.getenv("UPDATE_DEDUP_MARK_TTL", str(24 * 3600)))
+
+class UpdateDeduplicator:
+    def __init__(self, window, mark_ttl):
+        self.mark_ttl = mark_ttl
+        self._recent = deque(maxlen=window)
+        self._recent_set = set()
+        self._floor = -1  # update_id не больше этого значения уже обработаны
+        self.high_water_mark = None
+        self._mark_time = None  # когда high_water_mark вырос в последний раз
+
+    @property
+    def state(self):
+        # Значение для bot_state: "update_id время"
+        if self.high_water_mark is None:
+            return None
+        return f"{self.high_water_mark} {int(self._mark_time)}"
+
+    def _reset(self):
+        self._recent.clear()
+        self._recent_set.clear()
+        self._floor = -1
+        self.high_water_mark = None
+        self._mark_time = None
+
+    def restore(self, state, now):
+        if state is None:
+            return
+        parts = state.split()
+        if len(parts) != 2:
+            logger.warning("Ignoring stored update_id mark without a timestamp: %s", state)
+            return
+        last_update_id, mark_time = int(parts[0]), int(parts[1])
+        if now - mark_time > self.mark_ttl:
+            logger.warning("Ignoring stale update_id mark %s saved %s s ago.", last_update_id, int(now - mark_time))
+            return
+        self._floor = max(self._floor, last_update_id)
+        self.high_water_mark = self._floor
+        self._mark_time = mark_time
+        logger.info("Restored last processed update_id: %s", self._floor)
+
+    def check_and_mark(self, update_id, now=None):
+        # Возвращает True, если обновление новое, и запоминает его
+        now = time.time() if now is None else now
+        if self._mark_time is not None and now - self._mark_time > self.mark_ttl:
+            logger.info("No updates for %s s; starting a new update_id sequence.", int(now - self._mark_time))
+            self._reset()
+        elif update_id < self._floor - self._recent.maxlen:
+            logger.warning("update_id %s is far below the processed mark %s; assuming a new sequence.", update_id, self._floor)
+            self._reset()
+        if update_id <= self._floor or update_id in self._recent_set:
+            return False
+        if len(self._recent) == self._recent.maxlen:
+            evicted = self._recent[0]
+            self._recent_set.discard(evicted)
+            self._floor = max(self._floor, evicted)
+        self._recent.append(update_id)
+        self._recent_set.add(update_id)
+        if self.high_water_mark is None or update_id > self.high_water_mark:
+            self.high_water_mark = update_id
+            self._mark_time = now
+        return True
+
+    def forget(self, update_id):
+        # Обработка не удалась, и Telegram пришлёт обновление снова — его нужно принять
+        self._recent_set.discard(update_id)
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_MARK_TTL)
+message_counter.track_state("last_update_id", lambda: update_dedup.state)
+
+# --- Сервис счётчиков и режим нескольких процессов ---
+# При WEBHOOK_WORKERS > 1 вебхуки принимают N процессов uvicorn на одном порту, а база,
+# счётчики, кэш рангов, таблицы лидеров и защита от повторов живут только в главном
+# процессе-писателе. Обработчики обращаются к ним через counter_service: в одном процессе
+# это CounterService, в рабочих процессах — CounterClient, который передаёт те же вызовы
+# писателю по Unix-сокету (строка JSON на запрос), поэтому счётчики остаются точными.
+# HTTP писатель не обслуживает, поэтому рабочий процесс, ответивший на /metrics или /,
+# добавляет к своим сериям снимок метрик писателя (операция metrics): время запросов к
+# базе, кэш рангов, несброшенные счётчики и защита от флуда есть только там. Серии
+# различаются меткой process.
+COUNTER_SOCKET = os.getenv("COUNTER_SOCKET", f"{DB_PATH}.sock")
+COUNTER_OPS = frozenset(("count", "message_count", "top", "stats", "flood_offenders", "check_update", "forget_update", "load_state", "save_state", "metrics"))
+
+class CounterService:
+    async def count(self, chat_id, user_id, username, with_total=False, timestamp=None):
+        # (новое число сообщений или None, номер отброшенного из-за флуда сообщения или 0)
+        flood = flood_detector.check(chat_id, user_id, username, int(timestamp if timestamp is not None else time.time()))
+        if flood:
+            return None, flood
+        message_counter.increment(chat_id, user_id, username, timestamp)
+        if with_total:
+            return await self.message_count(chat_id, user_id), 0
+        return None, 0
+
+    async def message_count(self, chat_id, user_id):
+        stored_count, _ = await rank_cache.get(chat_id, user_id)
+        # Учитываем инкременты, которые ещё не сброшены в базу
+        return stored_count + message_counter.pending(chat_id, user_id)
+
+    async def top(self, chat_id, limit):
+        board = leaderboards.get(chat_id)
+        if board is None:
+            return []
+        return board.top(limit, lambda user_id: message_counter.pending(chat_id, user_id))
+
+    async def stats(self, chat_id, period):
+        table, buckets, _ = STATS_PERIODS[period]
+        # Сначала сбрасываем накопленные инкременты, чтобы сводка включала последние сообщения
+        await message_counter.flush()
+        current_bucket = activity_hour(time.time())
+        if table == "activity_daily":
+            current_bucket //= 24
+        return await db.get_activity_stats(chat_id, table, current_bucket - buckets + 1, STATS_TOP_LIMIT)
+
+    async def flood_offenders(self, chat_id):
+        return flood_detector.offenders(chat_id, time.time())
+
+    async def check_update(self, update_id):
+        return update_dedup.check_and_mark(update_id)
+
+    async def forget_update(self, update_id):
+        update_dedup.forget(update_id)
+
+    async def load_state(self, kind, key):
+        return await db.load_conversation_state(kind, key, int(time.time() - CONVERSATION_STATE_TTL))
+
+    async def save_state(self, kind, key, data):
+        await db.save_conversation_state(kind, key, data)
+
+    async def metrics(self):
+        return {"metrics": metrics.snapshot(), "rank_cache": rank_cache.stats()}
+
+class CounterServer:
+    def __init__(self, service, path):
+        self.service = service
+        self.path = path
+        self._server = None
+
+    async def start(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)  # сокет, оставшийся от прошлого запуска
+        self._server = await asyncio.start_unix_server(self._handle_connection, self.path)
+        logger.info("Counter service listening on %s.", self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    async def _handle_connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Задачи стартуют в порядке поступления запросов, поэтому инкременты одного
+                # процесса применяются по порядку; ответы могут уходить в другом порядке
+                task = asyncio.create_task(self._handle_request(json_loads(line), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request, writer):
+        request_id, op, args = request
+        try:
+            if op not in COUNTER_OPS:
+                raise ValueError(f"unknown operation {op!r}")
+            response = [request_id, await getattr(self.service, op)(*args), None]
+        except Exception as e:
+            metrics.inc("errors_total", (("where", "counter_service"),))
+            logger.error("Counter service operation %s failed: %s", op, e, exc_info=True)
+            response = [request_id, None, str(e)]
+        if not writer.is_closing():
+            writer.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+
+class CounterClient:
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self._reader_task = None
+        self._waiters = {}  # id запроса -> Future
+        self._next_id = 0
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = asyncio.create_task(self._read_responses(reader))
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+    async def _read_responses(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request_id, result, error = json_loads(line)
+                waiter = self._waiters.pop(request_id, None)
+                if waiter is None or waiter.done():
+                    continue
+                if error is None:
+                    waiter.set_result(result)
+                else:
+                    waiter.set_exception(RuntimeError(f"Counter service error: {error}"))
+        finally:
+            # Писатель недоступен: ожидающие вызовы завершаются ошибкой, а не висят
+            for waiter in self._waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("Counter service connection lost"))
+            self._waiters.clear()
+
+    async def _call(self, op, *args):
+        if self._reader_task is None or self._reader_task.done():
+            raise ConnectionError("Counter service is not connected")
+        self._next_id += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[self._next_id] = waiter
+        self._writer.write(json.dumps([self._next_id, op, args], ensure_ascii=False).encode() + b"\n")
+        return await waiter
+
+    async def count(self, chat_id, user_id, username, with_total=False, timestamp=None):
+        return await self._call("count", chat_id, user_id, username, with_total, timestamp)
+
+    async def message_count(self, chat_id, user_id):
+        return await self._call("message_count", chat_id, user_id)
+
+    async def top(self, chat_id, limit):
+        return await self._call("top", chat_id, limit)
+
+    async def stats(self, chat_id, period):
+        return await self._call("stats", chat_id, period)
+
+    async def flood_offenders(self, chat_id):
+        return await self._call("flood_offenders", chat_id)
+
+    async def check_update(self, update_id):
+        return await self._call("check_update", update_id)
+
+    async def forget_update(self, update_id):
+        await self._call("forget_update", update_id)
+
+    async def load_state(self, kind, key):
+        return await self._call("load_state", kind, key)
+
+    async def save_state(self, kind, key, data):
+        await self._call("save_state", kind, key, data)
+
+    async def metrics(self):
+        return await self._call("metrics")
+
+# В рабочих процессах заменяется на CounterClient
+counter_service = CounterService()
+
+# --- Хранилище состояния диалогов (user_data и chat_data) ---
+# Вместо словарей PTB, которые растут на запись для каждого пользователя и теряются при
+# перезапуске, context.user_data и context.chat_data берутся из ConversationStore: в памяти
+# не больше CONVERSATION_STATE_MAX_ENTRIES записей (LRU), записи без обращений дольше
+# CONVERSATION_STATE_TTL вытесняются, а каждое изменение сразу пишется в conversation_state
+# (в рабочих процессах — через писателя). Чтение из базы асинхронное, поэтому состояние
+# загружается до вызова обработчика и только для маршрутов с state=True.
+# Значения должны сериализоваться в JSON.
+CONVERSATION_STATE_MAX_ENTRIES = int(os.getenv("CONVERSATION_STATE_MAX_ENTRIES", "10000"))
+CONVERSATION_STATE_TTL = float(os.getenv("CONVERSATION_STATE_TTL", str(7 * 24 * 3600)))
+CONVERSATION_PURGE_INTERVAL = float(os.getenv("CONVERSATION_PURGE_INTERVAL", "3600"))
+
+class StoredDict(dict):
+    # Словарь, который сообщает хранилищу о каждом изменении
+    def __init__(self, store, kind, key, data):
+        super().__init__(data)
+        self._store = store
+        self._kind = kind
+        self._key = key
+
+    def _changed(self):
+        self._store.save(self._kind, self._key, self)
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self._changed()
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, name, *default):
+        changed = name in self
+        value = super().pop(name, *default)
+        if changed:
+            self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def clear(self):
+        if self:
+            super().clear()
+            self._changed()
+
+class ConversationStore:
+    def __init__(self, max_entries, ttl, cache=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # В рабочих процессах состояние мог изменить другой процесс, поэтому оно
+        # каждый раз читается у писателя, а в памяти только держится до конца обработки
+        self.cache = cache
+        self._entries = OrderedDict()  # (kind, key) -> [StoredDict, истекает_в]
+        self._save_tasks = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        # Порядок LRU совпадает с порядком истечения, поэтому истёкшие записи всегда в начале
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[1] > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    async def _get(self, kind, key, now):
+        entry = self._entries.get((kind, key))
+        if self.cache and entry and entry[1] > now:
+            entry[1] = now + self.ttl
+            self._entries.move_to_end((kind, key))
+            return entry[0]
+        data = StoredDict(self, kind, key, await counter_service.load_state(kind, key) or {})
+        self._entries[(kind, key)] = [data, now + self.ttl]
+        self._entries.move_to_end((kind, key))
+        return data
+
+    async def load(self, user_id, chat_id):
+        # Возвращает (user_data, chat_data); None, если идентификатора нет
+        now = time.monotonic()
+        user_data = await self._get("user", user_id, now) if user_id is not None else None
+        chat_data = await self._get("chat", chat_id, now) if chat_id is not None else None
+        self._evict(now)
+        return user_data, chat_data
+
+    def save(self, kind, key, data):
+        # Задачи стартуют в порядке изменений, а база (или соединение с писателем)
+        # выполняет запросы по очереди, поэтому последним записывается последнее состояние
+        task = asyncio.get_running_loop().create_task(counter_service.save_state(kind, key, dict(data)))
+        self._save_tasks.add(task)
+        task.add_done_callback(self._save_done)
+
+    def _save_done(self, task):
+        self._save_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            metrics.inc("errors_total", (("where", "conversation_state"),))
+            logger.error("Failed to save conversation state: %s", task.exception())
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(CONVERSATION_PURGE_INTERVAL)
+            try:
+                purged = await db.purge_conversation_state(int(time.time() - self.ttl))
+                if purged:
+                    logger.info("Removed %s expired conversation states.", purged)
+            except Exception as e:
+                logger.error("Failed to purge conversation states: %s", e, exc_info=True)
+
+    def start(self):
+        # Только там, где открыта база: в одном процессе или в писателе
+        if self._task is None:
+            self._task = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Дожидаемся записи последних изменений
+        await asyncio.gather(*self._save_tasks, return_exceptions=True)
+
+conversation_store = ConversationStore(CONVERSATION_STATE_MAX_ENTRIES, CONVERSATION_STATE_TTL, cache=WEBHOOK_WORKERS == 1)
+metrics.collect("conversation_states", "gauge", "Conversation states held in memory.", lambda: len(conversation_store))
+
+class ConversationContext(CallbackContext):
+    # context.user_data и context.chat_data из ConversationStore вместо словарей Application
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.conversation = None  # (user_data, chat_data), заполняет UpdateRouter.dispatch
+
+    @property
+    def user_data(self):
+        if self.conversation is None:
+            raise RuntimeError("user_data is only available to routes added with state=True")
+        return self.conversation[0]
+
+    @property
+    def chat_data(self):
+        if self.conversation is None:
+            raise RuntimeError("chat_data is only available to routes added with state=True")
+        return self.conversation[1]
+
+# --- Очередь обновлений для быстрого ответа на вебхук ---
+# В режиме WEBHOOK_FAST_ACK вебхук только кладёт обновление в очередь и сразу
+# отвечает 200. Обновления одного чата всегда попадают к одному и тому же
+# обработчику, поэтому порядок внутри чата сохраняется, а разные чаты
+# обрабатываются параллельно. UPDATE_QUEUE_SIZE ограничивает общее число
+# ожидающих обновлений, а не каждую шарду: почти весь поток идёт из одной группы.
+WEBHOOK_FAST_ACK = os.getenv("WEBHOOK_FAST_ACK", "0") == "1"
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "10"))
+
+class UpdateQueue:
+    def __init__(self, workers, max_size):
+        self.workers = workers
+        self.max_size = max_size
+        self._queued = 0  # принято, но ещё не обработано, во всех шардах
+        self._queues = []
+        self._tasks = []
+        self._accepting = False
+
+    def start(self, process_update):
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [
+            asyncio.create_task(self._worker(i, queue, process_update))
+            for i, queue in enumerate(self._queues)
+        ]
+        self._accepting = True
+        logger.info("Started %s update workers (queue size %s).", self.workers, self.max_size)
+
+    def put(self, update):
+        # Возвращает False, если очередь переполнена или уже закрыта
+        if not self._accepting or self._queued >= self.max_size:
+            return False
+        chat = update.effective_chat
+        key = chat.id if chat else (update.effective_user.id if update.effective_user else update.update_id)
+        self._queues[key % self.workers].put_nowait(update)
+        self._queued += 1
+        return True
+
+    def qsize(self):
+        return self._queued
+
+    async def _worker(self, index, queue, process_update):
+        while True:
+            update = await queue.get()
+            try:
+                await process_update(update)
+            except Exception as e:
+                metrics.inc("errors_total", (("where", "process_update"),))
+                logger.error("Worker %s failed to process update %s: %s", index, update.update_id, e, exc_info=True)
+            finally:
+                self._queued -= 1
+                queue.task_done()
+
+    async def drain(self, timeout):
+        # Перестаём принимать новые обновления и дожидаемся обработки уже принятых
+        self._accepting = False
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+            logger.info("Update queue drained.")
+        except asyncio.TimeoutError:
+            logger.warning("Update queue drain timed out after %ss with %s updates left.", timeout, self.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+metrics.collect("update_queue_size", "gauge", "Updates waiting in the fast-ack queue.", update_queue.qsize)
 
 # --- Эндпоинты FastAPI ---
+async def writer_metrics():
+    # Снимок метрик писателя в рабочем процессе; None в режиме одного процесса или если писатель не ответил
+    if not isinstance(counter_service, CounterClient):
+        return None
+    try:
+        return await counter_service.metrics()
+    except Exception as e:
+        metrics.inc("errors_total", (("where", "writer_metrics"),))
+        logger.error("Failed to fetch metrics from the counter service: %s", e)
+        return None
+
 @app.get("/")
 async def health_check():
     logger.info("Received health check GET / request. Responding 200 OK.")
-    return {"status": "ok", "message": "Bot is running"}
+    writer = await writer_metrics()
+    return {"status": "ok", "message": "Bot is running", "rank_cache": writer["rank_cache"] if writer else rank_cache.stats()}
+
+# Живость: процесс запущен и отвечает. Готовность: база открыта, Telegram
+# инициализирован и вебхук зарегистрирован (до этого application равен None)
+@app.get("/healthz")
+async def liveness():
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readiness():
+    if application is None:
+        return Response(status_code=503, content="Bot is starting up.", headers={"Retry-After": "1"})
+    return {"status": "ready"}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    writer = await writer_metrics()
+    content = metrics.render([writer["metrics"]] if writer else ())
+    return Response(content=content, media_type="text/plain; version=0.0.4")
+
+async def process_update(update):
+    with metrics.timer("process_update_seconds"):
+        await application.process_update(update)
+
+UPDATE_TYPES = frozenset(update_type.value for update_type in Update.ALL_TYPES)
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    global application
+    metrics.gauge_add("webhooks_in_flight", 1)
+    try:
+        return await handle_webhook(request)
+    finally:
+        metrics.gauge_add("webhooks_in_flight", -1)
+
+async def handle_webhook(request: Request):
     if application is None:
-        logger.critical("Telegram Application is not initialized. Cannot process webhook.")
-        return Response(status_code=500, content="Telegram Application not ready.")
+        # При FAST_STARTUP порт открыт раньше, чем бот готов; Telegram повторит доставку
+        logger.warning("Telegram Application is not initialized yet. Rejecting webhook.")
+        return Response(status_code=503, content="Telegram Application not ready.", headers={"Retry-After": "1"})
 
     try:
-        json_data = await request.json()
+        json_data = json_loads(await request.body())
+        if not isinstance(json_data, dict):
+            raise ValueError("payload is not a JSON object")
     except Exception as e:
-        logger.error(f"Failed to parse incoming JSON: {e}")
+        metrics.inc("errors_total", (("where", "webhook_json"),))
+        logger.error("Failed to parse incoming JSON: %s", e)
         return Response(status_code=400, content="Bad Request: Invalid JSON")
 
-    logger.info(f"Received webhook payload: {json_data.get('update_id', 'N/A')}")
+    # Ключ берётся из тела запроса, поэтому в метку попадают только известные типы:
+    # иначе каждый новый ключ навсегда добавлял бы серию метрик
+    update_type = next((key for key in json_data if key != "update_id"), "other")
+    if update_type not in UPDATE_TYPES:
+        update_type = "other"
+
+    # Обновления, которые никто не обработает (чужие чаты, правки, сервисные
+    # сообщения), подтверждаем сразу, не создавая объект Update
+    if not router.accepts_raw(json_data):
+        metrics.inc("updates_total", (("type", update_type), ("outcome", "filtered")))
+        return Response(status_code=200)
+
+    logger.info("Received webhook payload: %s", json_data.get('update_id', 'N/A'))
+
+    update_id = json_data.get("update_id")
+    if isinstance(update_id, int) and not await counter_service.check_update(update_id):
+        metrics.inc("updates_total", (("type", update_type), ("outcome", "duplicate")))
+        logger.info("Dropped duplicate update %s.", update_id)
+        return Response(status_code=200)
+
+    if INLINE_REPLIES:
+        reply = router.inline_reply(json_data, application.bot.username)
+        if reply is not None:
+            metrics.inc("updates_total", (("type", update_type), ("outcome", "inline")))
+            logger.info("Answered update %s inline in the webhook response.", update_id)
+            return Response(status_code=200, content=reply, media_type="application/json")
 
     try:
         update = Update.de_json(data=json_data, bot=application.bot)
     except Exception as e:
-        logger.error(f"Failed to parse webhook JSON into Update object: {e}", exc_info=True)
+        await counter_service.forget_update(update_id)
+        metrics.inc("errors_total", (("where", "webhook_update"),))
+        logger.error("Failed to parse webhook JSON into Update object: %s", e, exc_info=True)
         return Response(status_code=400, content=f"Bad Request: Could not parse Update object: {e}")
 
+    if WEBHOOK_FAST_ACK:
+        if not update_queue.put(update):
+            await counter_service.forget_update(update_id)
+            metrics.inc("updates_total", (("type", update_type), ("outcome", "rejected")))
+            logger.warning("Update queue is full, rejecting update %s.", json_data.get('update_id', 'N/A'))
+            return Response(status_code=503, content="Update queue is full.", headers={"Retry-After": "1"})
+        metrics.inc("updates_total", (("type", update_type), ("outcome", "queued")))
+        return Response(status_code=200)
+
     try:
-        await application.process_update(update)
-        logger.info(f"Webhook processed successfully for update_id: {json_data.get('update_id', 'N/A')}.")
+        await process_update(update)
+        metrics.inc("updates_total", (("type", update_type), ("outcome", "processed")))
+        logger.info("Webhook processed successfully for update_id: %s.", json_data.get('update_id', 'N/A'))
         return Response(status_code=200)
     except Exception as e:
-        logger.error(f"Error processing update {json_data.get('update_id', 'N/A')}: {e}", exc_info=True)
+        metrics.inc("errors_total", (("where", "process_update"),))
+        logger.error("Error processing update %s: %s", json_data.get('update_id', 'N/A'), e, exc_info=True)
+        await counter_service.forget_update(update_id)
         return Response(status_code=500, content=f"Internal Server Error: {e}")
 
 # --- Основная функция запуска бота ---
+# FAST_STARTUP=1: uvicorn открывает порт до инициализации, /healthz сразу отвечает 200,
+# а /readyz и /webhook отдают 503, пока база и Telegram не готовы. Личность бота (getMe)
+# и URL зарегистрированного вебхука кешируются в bot_state, поэтому повторный запуск
+# с тем же токеном и адресом не делает сетевых запросов к Bot API. STARTUP_CACHE=0
+# отключает кеш (например, если вебхук удалили вручную).
+FAST_STARTUP = os.getenv("FAST_STARTUP", "0") == "1"
+STARTUP_CACHE = os.getenv("STARTUP_CACHE", "1") == "1"
+
+def build_application(token, base_url=None):
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(SendScheduler())
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(10.0)
+        .http_version(TELEGRAM_HTTP_VERSION)
+        .context_types(ContextTypes(context=ConversationContext))
+    )
+    if base_url:
+        # Нестандартный адрес Bot API (локальный сервер или заглушка в бенчмарке)
+        builder = builder.base_url(base_url)
+    telegram_app = builder.build()
+    # Все обновления проходят через единый маршрутизатор
+    telegram_app.add_handler(TypeHandler(Update, router.dispatch))
+    return telegram_app
+
+async def start_telegram(telegram_app, token, webhook_url):
+    # Кеш привязан к id бота из токена: после смены токена всё запрашивается заново
+    bot_id = token.split(":", 1)[0]
+    identity = await db.get_state("bot_identity") if STARTUP_CACHE else None
+    if identity:
+        identity = json.loads(identity)
+        if str(identity.get("id")) == bot_id:
+            telegram_app.bot.rate_limiter.cached_identity = identity
+            logger.info("Using cached bot identity @%s.", identity.get("username"))
+        else:
+            identity = None
+    await telegram_app.initialize()
+    if not identity:
+        await db.set_state("bot_identity", json.dumps(telegram_app.bot.bot.to_dict()))
+
+    # --- Установка вебхука ---
+    webhook_state = f"{bot_id} {webhook_url}"
+    if STARTUP_CACHE and await db.get_state("webhook") == webhook_state:
+        logger.info("Webhook %s was registered by a previous start. Skipping.", webhook_url)
+        return
+    logger.info("Attempting to set webhook to: %s", webhook_url)
+    try:
+        current_webhook_info = await telegram_app.bot.get_webhook_info()
+        if current_webhook_info.url != webhook_url:
+            await telegram_app.bot.set_webhook(url=webhook_url)
+            logger.info("Webhook set successfully!")
+        else:
+            logger.info("Webhook is already set to the correct URL. Skipping.")
+    except TelegramError as e:
+        logger.critical("Failed to set webhook: %s", e, exc_info=True)
+        raise
+    await db.set_state("webhook", webhook_state)
+
+async def start_services():
+    # База, состояние в памяти и фоновые задачи; вызывается до приёма вебхуков
+    await db.open()
+    update_dedup.restore(await db.get_state("last_update_id"), time.time())
+    for group_id in settings.discussion_groups:
+        leaderboards[group_id] = Leaderboard(LEADERBOARD_SIZE)
+        leaderboards[group_id].load(await db.get_top_users(group_id, LEADERBOARD_SIZE))
+    logger.info("Loaded settings for %s discussion groups, leaderboards rebuilt.", len(settings.discussion_groups))
+    message_counter.start()
+    activity_compactor.start()
+    conversation_store.start()
+    if WEBHOOK_FAST_ACK:
+        update_queue.start(process_update)
+
+async def stop_services():
+    # Дообрабатываем уже принятые обновления, затем сбрасываем счётчики
+    await update_queue.drain(UPDATE_DRAIN_TIMEOUT)
+    await conversation_store.stop()
+    await activity_compactor.stop()
+    await message_counter.stop()
+    await db.close()
+
+async def serve_workers(config, telegram_app):
+    # Процесс-писатель: открывает порт один раз, а соединения принимают рабочие процессы
+    metrics.process_labels = (("process", "writer"),)
+    counter_server = CounterServer(counter_service, COUNTER_SOCKET)
+    await counter_server.start()
+    sock = config.bind_socket()
+    identity = telegram_app.bot.bot.to_dict()
+    spawn_context = multiprocessing.get_context("spawn")
+    workers = {}
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    def spawn(index):
+        process = spawn_context.Process(target=run_worker, args=(sock, index, identity), name=f"webhook-worker-{index}")
+        process.start()
+        workers[index] = process
+
+    for index in range(WEBHOOK_WORKERS):
+        spawn(index)
+    logger.info("Started %s webhook worker processes on port %s.", WEBHOOK_WORKERS, config.port)
+    try:
+        while not stopping.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), 1.0)
+            for index, process in list(workers.items()):
+                if not process.is_alive() and not stopping.is_set():
+                    logger.error("Webhook worker %s exited with code %s, restarting.", index, process.exitcode)
+                    spawn(index)
+    finally:
+        # Рабочие процессы дообрабатывают принятые обновления, пока писатель ещё отвечает им
+        for process in workers.values():
+            process.terminate()
+        await loop.run_in_executor(None, lambda: [process.join() for process in workers.values()])
+        sock.close()
+        await counter_server.stop()
+        logger.info("All webhook worker processes stopped.")
+
+def run_worker(sock, index, identity):
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        asyncio.run(serve_worker(sock, index, identity))
+    except Exception as e:
+        logger.critical("Webhook worker %s failed: %s", index, e, exc_info=True)
+        raise
+
+async def serve_worker(sock, index, identity):
+    global application, counter_service
+    import uvicorn
+
+    metrics.process_labels = (("process", f"worker{index}"),)
+    metrics.is_worker = True
+    counter_service = CounterClient(COUNTER_SOCKET)
+    await counter_service.connect()
+    telegram_app = build_application(os.getenv("BOT_TOKEN"), os.getenv("TELEGRAM_API_URL"))
+    # Писатель уже получил личность бота и зарегистрировал вебхук: здесь запросов к API нет
+    telegram_app.bot.rate_limiter.cached_identity = identity
+    await telegram_app.initialize()
+    if WEBHOOK_FAST_ACK:
+        update_queue.start(process_update)
+    application = telegram_app
+    server = uvicorn.Server(uvicorn.Config(app, log_config=None))
+    logger.info("Webhook worker %s (pid %s) is ready.", index, os.getpid())
+    try:
+        await server.serve(sockets=[sock])
+    finally:
+        await update_queue.drain(UPDATE_DRAIN_TIMEOUT)
+        await conversation_store.stop()
+        await counter_service.close()
+        await telegram_app.shutdown()
+
+def handle_sigterm(signum, frame):
+    # uvicorn после остановки заново посылает пойманный SIGTERM; с обработчиком по
+    # умолчанию процесс завершился бы до stop_services и несброшенные счётчики пропали бы
+    raise SystemExit(0)
+
 async def main():
     global application
     token = os.getenv("BOT_TOKEN")
@@ -470,80 +2545,58 @@ async def main():
         logger.critical("BOT_TOKEN environment variable is not set. Bot cannot start.")
         raise ValueError("BOT_TOKEN environment variable is not set")
 
-    init_db()
-
-    application = Application.builder().token(token).build()
-    await application.initialize()
-
-    # --- Установка вебхука ---
     render_hostname = os.getenv("RENDER_EXTERNAL_HOSTNAME")
     if not render_hostname:
         logger.critical("RENDER_EXTERNAL_HOSTNAME environment variable is not set. Cannot determine webhook URL.")
         raise ValueError("RENDER_EXTERNAL_HOSTNAME is not set. Webhook URL cannot be determined automatically.")
-
     webhook_url = f"https://{render_hostname}/webhook"
-    logger.info(f"Attempting to set webhook to: {webhook_url}")
 
-    try:
-        current_webhook_info = await application.bot.get_webhook_info()
-        if current_webhook_info.url != webhook_url:
-            await application.bot.set_webhook(url=webhook_url)
-            logger.info("Webhook set successfully!")
-        else:
-            logger.info("Webhook is already set to the correct URL. Skipping.")
-    except TelegramError as e:
-        logger.critical(f"Failed to set webhook: {e}", exc_info=True)
-        raise
-
-    # --- Добавляем обработчики ---
-    # Команды для любого типа чата
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("info", info_command))
-    application.add_handler(CommandHandler("echo", echo_command)) # Echo может быть в группах, но будет работать только в личных
-    application.add_handler(CommandHandler("random", random_command)) # Random только в личных
-
-    # Сообщения, ожидающие диапазона для random (приватные чаты)
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-        handle_random_range
-    ))
-
-    # Общие текстовые сообщения в приватных чатах (должен быть после других обработчиков приватных сообщений)
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-        handle_private_message
-    ))
-
-    # Команды и сообщения для групп (ДИСКУССИОННАЯ ГРУППА)
-    application.add_handler(CommandHandler("site", site))
-    application.add_handler(CommandHandler("servers", servers))
-    application.add_handler(CommandHandler("partners", partners))
-    application.add_handler(CommandHandler("ping", ping))
-    application.add_handler(CommandHandler("rank", rank))
-
-    # Обработчик для команды /help (может быть как в приватных, так и в группах)
-    application.add_handler(CommandHandler("help", help_command))
-
-    # Обработчик для пересланных постов из канала в дискуссионной группе
-    application.add_handler(MessageHandler(
-        filters.FORWARDED & filters.ChatType.GROUPS,
-        handle_forwarded_post_in_discussion
-    ))
-
-    # Обработчик для подсчёта сообщений в группе (не команды, не форварды, не сервисные сообщения)
-    application.add_handler(MessageHandler(
-        filters.ALL & ~filters.COMMAND & ~filters.FORWARDED & filters.ChatType.GROUPS,
-        count_messages
-    ))
+    # uvicorn нужен только здесь; импорт не замедляет загрузку модуля (бенчмарк, утилиты)
+    import uvicorn
 
     port = int(os.getenv("PORT", 10000))
-    logger.info(f"Starting Uvicorn server on host 0.0.0.0 and port {port}")
-    config = uvicorn.Config(app, host="0.0.0.0", port=port)
+    # log_config=None: логи uvicorn идут через общую очередь логирования
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_config=None)
     server = uvicorn.Server(config)
-    await server.serve()
+    server_task = None
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    # С несколькими процессами порт открывается только после инициализации писателя
+    if FAST_STARTUP and WEBHOOK_WORKERS == 1:
+        logger.info("Starting Uvicorn server on host 0.0.0.0 and port %s before initialization", port)
+        server_task = asyncio.create_task(server.serve())
+
+    try:
+        telegram_app = build_application(token, os.getenv("TELEGRAM_API_URL"))
+        # Кеш запуска лежит в базе, поэтому она открывается первой; дальше загрузка
+        # состояния и инициализация Telegram идут параллельно
+        await db.open()
+        # return_exceptions: при ошибке одной ветви другая дорабатывает до конца, прежде
+        # чем finally остановит сервисы и закроет базу
+        results = await asyncio.gather(
+            start_services(), start_telegram(telegram_app, token, webhook_url), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if WEBHOOK_WORKERS > 1:
+            await serve_workers(config, telegram_app)
+            return
+        application = telegram_app
+        logger.info("Bot is ready to process updates.")
+
+        if server_task is None:
+            logger.info("Starting Uvicorn server on host 0.0.0.0 and port %s", port)
+            await server.serve()
+        else:
+            await server_task
+    finally:
+        if server_task is not None and not server_task.done():
+            server.should_exit = True
+            await server_task
+        await stop_services()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except Exception as e:
-        logger.critical(f"Bot failed to start: {e}", exc_info=True)
+        logger.critical("Bot failed to start: %s", e, exc_info=True)